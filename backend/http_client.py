@@ -0,0 +1,123 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import Dict
+from urllib.parse import urlsplit
+
+import httpx
+
+from metrics import InstrumentedTransport
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+WUZAPI_TIMEOUT = float(os.environ.get('WUZAPI_TIMEOUT', '30'))
+PANEL_TIMEOUT = float(os.environ.get('PANEL_TIMEOUT', '10'))
+HTTP_MAX_CONNECTIONS = int(os.environ.get('HTTP_MAX_CONNECTIONS', '100'))
+HTTP_MAX_KEEPALIVE = int(os.environ.get('HTTP_MAX_KEEPALIVE', '20'))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get('HTTP_KEEPALIVE_EXPIRY', '30'))
+# Requisições simultâneas permitidas por host de painel IPTV
+PANEL_HOST_CONCURRENCY = int(os.environ.get('PANEL_HOST_CONCURRENCY', '5'))
+
+
+def host_of(url: str) -> str:
+    parts = urlsplit(url)
+    return parts.netloc or url
+
+
+class HTTPClients:
+    """Clientes HTTP compartilhados pela aplicação (WuzAPI e painéis IPTV)"""
+
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+        self._requests: Dict[str, Dict[str, int]] = {}
+        self._in_flight: Dict[str, int] = {}
+
+    def _create(self, name: str, timeout: float) -> httpx.AsyncClient:
+        counters = self._requests.setdefault(name, {})
+
+        async def count_request(request: httpx.Request):
+            host = request.url.netloc.decode()
+            counters[host] = counters.get(host, 0) + 1
+
+        # httpx keeps one connection pool per origin inside each client
+        transport = httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            http2=HTTP2_AVAILABLE,
+        )
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout),
+            transport=InstrumentedTransport(name, transport),
+            event_hooks={"request": [count_request]},
+        )
+
+    def _get(self, name: str, timeout: float) -> httpx.AsyncClient:
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            client = self._clients[name] = self._create(name, timeout)
+        return client
+
+    @property
+    def wuzapi(self) -> httpx.AsyncClient:
+        return self._get("wuzapi", WUZAPI_TIMEOUT)
+
+    @property
+    def panels(self) -> httpx.AsyncClient:
+        return self._get("panels", PANEL_TIMEOUT)
+
+    @asynccontextmanager
+    async def panel_slot(self, url: str):
+        """Limita requisições simultâneas ao mesmo painel"""
+        host = host_of(url)
+        slot = self._host_slots.get(host)
+        if slot is None:
+            slot = self._host_slots[host] = asyncio.Semaphore(PANEL_HOST_CONCURRENCY)
+        async with slot:
+            self._in_flight[host] = self._in_flight.get(host, 0) + 1
+            try:
+                yield
+            finally:
+                self._in_flight[host] -= 1
+
+    async def start(self):
+        self._get("wuzapi", WUZAPI_TIMEOUT)
+        self._get("panels", PANEL_TIMEOUT)
+
+    async def close(self):
+        clients, self._clients = self._clients, {}
+        await asyncio.gather(*(client.aclose() for client in clients.values()), return_exceptions=True)
+
+    def stats(self) -> dict:
+        pools = {}
+        for name, client in self._clients.items():
+            # httpcore does not expose pool usage publicly; read it defensively
+            pool = getattr(getattr(client, "_transport", None), "_pool", None)
+            connections = list(getattr(pool, "connections", []) or [])
+            pools[name] = {
+                "connections": len(connections),
+                "idle": sum(1 for c in connections if c.is_idle()),
+                "requests_by_host": dict(self._requests.get(name, {})),
+            }
+        return {
+            "http2": HTTP2_AVAILABLE,
+            "limits": {
+                "max_connections": HTTP_MAX_CONNECTIONS,
+                "max_keepalive_connections": HTTP_MAX_KEEPALIVE,
+                "keepalive_expiry": HTTP_KEEPALIVE_EXPIRY,
+                "panel_host_concurrency": PANEL_HOST_CONCURRENCY,
+            },
+            "timeouts": {"wuzapi": WUZAPI_TIMEOUT, "panels": PANEL_TIMEOUT},
+            "pools": pools,
+            "panel_in_flight": {host: n for host, n in self._in_flight.items() if n},
+        }
+
+
+http_clients = HTTPClients()
@@ -0,0 +1,148 @@
+import asyncio
+import os
+import socket
+import time
+
+import httpx
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+from pymongo import monitoring
+
+# Rótulo que distingue as réplicas do Swarm (ex.: REPLICA_NAME={{.Task.Name}})
+REPLICA = os.environ.get('REPLICA_NAME') or socket.gethostname()
+EVENT_LOOP_LAG_INTERVAL = float(os.environ.get('EVENT_LOOP_LAG_INTERVAL', '1'))
+
+# Images that start uvicorn directly do not create the multiprocess directory
+if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MONGO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+http_requests = Counter(
+    "admtv_http_requests_total", "HTTP requests handled",
+    ["replica", "method", "route", "status"],
+)
+http_latency = Histogram(
+    "admtv_http_request_duration_seconds", "HTTP request latency by route template",
+    ["replica", "method", "route"], buckets=LATENCY_BUCKETS,
+)
+mongo_latency = Histogram(
+    "admtv_mongo_command_duration_seconds", "MongoDB command latency",
+    ["replica", "collection", "command"], buckets=MONGO_BUCKETS,
+)
+mongo_failures = Counter(
+    "admtv_mongo_command_failures_total", "MongoDB commands that failed",
+    ["replica", "collection", "command"],
+)
+outbound_latency = Histogram(
+    "admtv_outbound_request_duration_seconds", "Outbound HTTP latency (WuzAPI and IPTV panels)",
+    ["replica", "client", "host"], buckets=LATENCY_BUCKETS,
+)
+outbound_requests = Counter(
+    "admtv_outbound_requests_total", "Outbound HTTP requests by outcome (2xx..5xx or error)",
+    ["replica", "client", "host", "outcome"],
+)
+event_loop_lag = Gauge(
+    "admtv_event_loop_lag_seconds", "How late the event loop woke up a timer",
+    ["replica"], multiprocess_mode="max",
+)
+
+
+class PrometheusMiddleware:
+    """Middleware ASGI que mede requisições pelo template da rota"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router stores the matched route in the shared scope; using its
+            # template keeps label cardinality bounded
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            method = scope["method"]
+            http_latency.labels(REPLICA, method, route).observe(time.perf_counter() - start)
+            http_requests.labels(REPLICA, method, route, str(status)).inc()
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Mede a latência de cada comando enviado ao MongoDB"""
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        target = event.command.get("collection") if event.command_name == "getMore" else event.command.get(event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = target if isinstance(target, str) else "-"
+
+    def _finish(self, event, failed: bool):
+        collection = self._collections.pop((event.connection_id, event.request_id), "-")
+        mongo_latency.labels(REPLICA, collection, event.command_name).observe(event.duration_micros / 1e6)
+        if failed:
+            mongo_failures.labels(REPLICA, collection, event.command_name).inc()
+
+    def succeeded(self, event):
+        self._finish(event, failed=False)
+
+    def failed(self, event):
+        self._finish(event, failed=True)
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """Transporte httpx que mede chamadas externas até a chegada dos cabeçalhos"""
+
+    def __init__(self, name: str, transport: httpx.AsyncHTTPTransport):
+        self.name = name
+        self._transport = transport
+
+    @property
+    def _pool(self):
+        return getattr(self._transport, "_pool", None)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.netloc.decode()
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            response = await self._transport.handle_async_request(request)
+            outcome = f"{response.status_code // 100}xx"
+            return response
+        finally:
+            outbound_latency.labels(REPLICA, self.name, host).observe(time.perf_counter() - start)
+            outbound_requests.labels(REPLICA, self.name, host, outcome).inc()
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+async def event_loop_lag_monitor():
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        event_loop_lag.labels(REPLICA).set(max(time.perf_counter() - start - EVENT_LOOP_LAG_INTERVAL, 0.0))
+
+
+def render_metrics() -> tuple:
+    # With several uvicorn workers, PROMETHEUS_MULTIPROC_DIR makes every worker
+    # write to a shared directory that is aggregated on each scrape
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,201 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import Optional
+
+from pymongo import monitoring
+
+logger = logging.getLogger("query_monitor")
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+# Requests doing more round trips than this are logged (N+1 patterns)
+ROUND_TRIPS_WARN = int(os.environ.get('ROUND_TRIPS_WARN', '20'))
+QUERY_SHAPES_MAX = int(os.environ.get('QUERY_SHAPES_MAX', '500'))
+RECENT_SLOW_MAX = int(os.environ.get('RECENT_SLOW_MAX', '100'))
+
+# Comandos internos do driver que não dizem nada sobre a aplicação
+IGNORED_COMMANDS = {"hello", "isMaster", "ismaster", "ping", "endSessions", "saslStart", "saslContinue", "buildInfo"}
+
+
+class RequestQueries:
+    """Comandos enviados ao Mongo durante uma requisição"""
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.round_trips = 0
+        self.finished = False
+
+    @property
+    def route(self) -> str:
+        if self.finished:
+            # Tasks spawned by the request keep its context after it returned
+            return "background"
+        return f'{self.scope["method"]} {getattr(self.scope.get("route"), "path", None) or "unmatched"}'
+
+
+current_request: ContextVar[Optional[RequestQueries]] = ContextVar("current_request", default=None)
+
+
+def query_shape(value):
+    """Troca os valores por '?' mantendo campos e operadores"""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = [query_shape(item) for item in value]
+        # $in/$nin lists collapse to one element so their length does not create new shapes
+        if shapes and all(shape == "?" for shape in shapes):
+            return ["?"]
+        return shapes
+    return "?"
+
+
+def command_shape(command_name: str, command: dict):
+    if command_name in ("find", "count", "distinct"):
+        return query_shape(command.get("filter", command.get("query", {})))
+    if command_name == "aggregate":
+        return [
+            {name: query_shape(body)} if name == "$match" else name
+            for stage in command.get("pipeline", []) for name, body in stage.items()
+        ]
+    if command_name == "findAndModify":
+        return query_shape(command.get("query", {}))
+    if command_name == "update":
+        return [query_shape(update.get("q", {})) for update in command.get("updates", [])[:1]]
+    if command_name == "delete":
+        return [query_shape(delete.get("q", {})) for delete in command.get("deletes", [])[:1]]
+    return None
+
+
+class QueryMonitor(monitoring.CommandListener):
+    """Registra comandos lentos e quantas idas ao Mongo cada rota faz"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._shapes: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._routes = {}
+        self._recent_slow = deque(maxlen=RECENT_SLOW_MAX)
+
+    # -- pymongo listener: runs in Motor's executor threads, inside the caller's context --
+
+    def started(self, event):
+        if event.command_name in IGNORED_COMMANDS:
+            return
+        request = current_request.get()
+        if request is not None and not request.finished:
+            request.round_trips += 1
+        collection = event.command.get("collection") if event.command_name == "getMore" else event.command.get(event.command_name)
+        self._pending[(event.connection_id, event.request_id)] = (
+            request.route if request is not None else "background",
+            collection if isinstance(collection, str) else "-",
+            repr(command_shape(event.command_name, event.command)),
+        )
+
+    def _finish(self, event, failed: bool):
+        pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is None:
+            return
+        route, collection, shape = pending
+        duration_ms = event.duration_micros / 1000
+        slow = duration_ms >= SLOW_QUERY_MS
+        key = (route, collection, event.command_name, shape)
+        with self._lock:
+            stats = self._shapes.get(key)
+            if stats is None:
+                stats = self._shapes[key] = {"count": 0, "slow": 0, "failed": 0, "total_ms": 0.0, "max_ms": 0.0}
+            stats['count'] += 1
+            stats['slow'] += slow
+            stats['failed'] += failed
+            stats['total_ms'] += duration_ms
+            stats['max_ms'] = max(stats['max_ms'], duration_ms)
+            stats['last_seen'] = time.time()
+            self._shapes.move_to_end(key)
+            while len(self._shapes) > QUERY_SHAPES_MAX:
+                self._shapes.popitem(last=False)
+            if slow:
+                self._recent_slow.append({
+                    "at": time.time(), "route": route, "collection": collection,
+                    "command": event.command_name, "shape": shape, "duration_ms": round(duration_ms, 2),
+                })
+        if slow:
+            logger.warning("Slow %s on %s (%.1f ms) from %s: %s", event.command_name, collection, duration_ms, route, shape)
+
+    def succeeded(self, event):
+        self._finish(event, failed=False)
+
+    def failed(self, event):
+        self._finish(event, failed=True)
+
+    # -- request accounting --
+
+    def record_request(self, request: RequestQueries):
+        route = request.route
+        with self._lock:
+            stats = self._routes.get(route)
+            if stats is None:
+                stats = self._routes[route] = {"requests": 0, "round_trips": 0, "max_round_trips": 0}
+            stats['requests'] += 1
+            stats['round_trips'] += request.round_trips
+            stats['max_round_trips'] = max(stats['max_round_trips'], request.round_trips)
+        if request.round_trips > ROUND_TRIPS_WARN:
+            logger.warning("%s made %d MongoDB round trips", route, request.round_trips)
+
+    def report(self, limit: int = 20, sort: str = "total_ms") -> dict:
+        with self._lock:
+            shapes = [
+                {"route": route, "collection": collection, "command": command, "shape": shape,
+                 **stats, "avg_ms": stats['total_ms'] / stats['count']}
+                for (route, collection, command, shape), stats in self._shapes.items()
+            ]
+            routes = [
+                {"route": route, **stats, "avg_round_trips": stats['round_trips'] / stats['requests']}
+                for route, stats in self._routes.items()
+            ]
+            recent_slow = list(self._recent_slow)
+        shapes.sort(key=lambda item: item[sort], reverse=True)
+        routes.sort(key=lambda item: item['avg_round_trips'], reverse=True)
+        for item in shapes:
+            item['total_ms'], item['max_ms'], item['avg_ms'] = (
+                round(item['total_ms'], 2), round(item['max_ms'], 2), round(item['avg_ms'], 2))
+        for item in routes:
+            item['avg_round_trips'] = round(item['avg_round_trips'], 2)
+        return {
+            "slow_query_ms": SLOW_QUERY_MS,
+            "round_trips_warn": ROUND_TRIPS_WARN,
+            "shapes": shapes[:limit],
+            "routes": routes[:limit],
+            "recent_slow": recent_slow[::-1][:limit],
+        }
+
+    def reset(self):
+        with self._lock:
+            self._shapes.clear()
+            self._routes.clear()
+            self._recent_slow.clear()
+
+
+query_monitor = QueryMonitor()
+
+
+class QueryMonitorMiddleware:
+    """Middleware ASGI que associa os comandos do Mongo à requisição atual"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request = RequestQueries(scope)
+        token = current_request.set(request)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_request.reset(token)
+            query_monitor.record_request(request)
+            request.finished = True
@@ -1,28 +1,61 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Header, Request, Response, UploadFile, File, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
-from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional
-from datetime import datetime, timezone, timedelta
+from bson.regex import Regex
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, ExecutionTimeout, OperationFailure
+from pydantic import BaseModel, Field, ConfigDict, EmailStr, ValidationError, field_validator, model_validator
+from typing import Dict, List, Optional
+from datetime import datetime, timezone, timedelta, date as dt_date, time as dt_time
+from zoneinfo import ZoneInfo
+from concurrent.futures import ThreadPoolExecutor
 import os
+import io
+import re
+import unicodedata
+import csv
+import codecs
+import itertools
+import contextlib
+import zipfile
+import json
+import zlib
+import base64
+import hashlib
 import logging
+import asyncio
+import math
+import time
+import socket
+import secrets
 from pathlib import Path
 import jwt
+import orjson
 from passlib.context import CryptContext
-import httpx
 import uuid
-from wuzapi import send_whatsapp_message, format_expiring_message
+from wuzapi import send_whatsapp_message, format_expiring_message, wuzapi_breaker
+from cache import TTLCache, cache_stats
+from http_client import PANEL_HOST_CONCURRENCY, http_clients
+from throttle import FailureThrottle
+from metrics import MongoCommandMetrics, PrometheusMiddleware, event_loop_lag_monitor, render_metrics
+from query_monitor import QueryMonitorMiddleware, query_monitor
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True, tzinfo=timezone.utc, event_listeners=[MongoCommandMetrics(), query_monitor])
 db = client[os.environ['DB_NAME']]
 
+# Dates without an offset (the admin's yyyy-MM-dd inputs, legacy strings) are
+# wall-clock values in the business timezone
+BUSINESS_TIMEZONE = ZoneInfo(os.environ.get('BUSINESS_TIMEZONE', 'America/Sao_Paulo'))
+
 # Security
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
@@ -30,6 +63,34 @@ SECRET_KEY = os.environ.get('SECRET_KEY', 'your-secret-key-change-in-production'
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
 
+# bcrypt runs on a small dedicated pool; requests beyond the queue are refused
+# instead of piling up behind it
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '2'))
+PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', '32'))
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+password_pending = 0
+
+# Failed logins are counted per email and per client IP and checked before bcrypt runs
+LOGIN_THROTTLE_WINDOW = float(os.environ.get('LOGIN_THROTTLE_WINDOW', '900'))
+login_email_throttle = FailureThrottle(
+    "login_email", int(os.environ.get('LOGIN_MAX_FAILURES_PER_EMAIL', '5')), LOGIN_THROTTLE_WINDOW
+)
+login_ip_throttle = FailureThrottle(
+    "login_ip", int(os.environ.get('LOGIN_MAX_FAILURES_PER_IP', '20')), LOGIN_THROTTLE_WINDOW
+)
+# Proxies in front of the app (Traefik) that append to X-Forwarded-For. Without a
+# proxy the header comes from the client, so it is only read when this is set
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '0'))
+
+# Auth fast path: verified token claims and admin records, bounded by TTL
+AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', '60'))
+token_cache = TTLCache("auth_tokens", ttl=AUTH_CACHE_TTL, maxsize=4096)
+admin_cache = TTLCache("auth_admins", ttl=AUTH_CACHE_TTL, maxsize=1024)
+
+# Public portal payloads, per username
+PORTAL_CACHE_TTL = float(os.environ.get('PORTAL_CACHE_TTL', '30'))
+portal_cache = TTLCache("portal", ttl=PORTAL_CACHE_TTL, maxsize=10000)
+
 # Create the main app
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
@@ -69,6 +130,38 @@ class User(BaseModel):
     pin: str = "0000"
     plan_price: Optional[float] = None
     pay_url: Optional[str] = None
+    last_validation: Optional[dict] = None
+
+    @model_validator(mode="before")
+    @classmethod
+    def legacy_expire_date(cls, data):
+        # Suporte para campo antigo expire_date (merged by the native dates migration)
+        if isinstance(data, dict) and 'expires_at' not in data and 'expire_date' in data:
+            data = {**data, 'expires_at': data['expire_date']}
+        return data
+
+def as_aware_datetime(value: Optional[datetime]) -> Optional[datetime]:
+    if value is not None and value.tzinfo is None:
+        value = value.replace(tzinfo=BUSINESS_TIMEZONE)
+    return value.astimezone(timezone.utc) if value is not None else None
+
+def parse_stored_datetime(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if isinstance(value, datetime):
+        # Legacy isoformat strings were written without an offset from the
+        # admin's local dates
+        value = as_aware_datetime(value)
+    return value
+
+def read_stored_datetime(value) -> Optional[datetime]:
+    # Strings remain while the date migration is running, for values it could not
+    # parse and from replicas still on an older release
+    try:
+        value = parse_stored_datetime(value)
+    except ValueError:
+        return None
+    return value if isinstance(value, datetime) else None
 
 class UserCreate(BaseModel):
     username: str
@@ -82,6 +175,8 @@ class UserCreate(BaseModel):
     plan_price: Optional[float] = None
     pay_url: Optional[str] = None
 
+    _aware_expires_at = field_validator("expires_at")(as_aware_datetime)
+
 class UserUpdate(BaseModel):
     username: Optional[str] = None
     password: Optional[str] = None
@@ -95,6 +190,8 @@ class UserUpdate(BaseModel):
     plan_price: Optional[float] = None
     pay_url: Optional[str] = None
 
+    _aware_expires_at = field_validator("expires_at")(as_aware_datetime)
+
 class DNS(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -156,6 +253,35 @@ class SettingsUpdate(BaseModel):
     whatsapp_instance: Optional[str] = None
     whatsapp_token: Optional[str] = None
 
+class BulkValidateRequest(BaseModel):
+    user_ids: Optional[List[str]] = None
+    dns_id: Optional[str] = None
+    active: Optional[bool] = None
+    estimate_channels: bool = False
+
+class BulkUserFilter(BaseModel):
+    user_ids: Optional[List[str]] = None
+    dns_id: Optional[str] = None
+    active: Optional[bool] = None
+
+class BulkRenewRequest(BulkUserFilter):
+    days: int = Field(gt=0, le=3650)
+    from_now_if_expired: bool = True
+
+class BulkActiveRequest(BulkUserFilter):
+    set_active: bool
+
+class BulkDNSRequest(BulkUserFilter):
+    target_dns_id: str
+
+class UserPage(BaseModel):
+    items: List[dict]
+    next_cursor: Optional[str] = None
+
+class PaymentPage(BaseModel):
+    items: List[dict]
+    next_cursor: Optional[str] = None
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -167,6 +293,8 @@ class Stats(BaseModel):
     total_dns: int
     total_revenue: float
     recent_payments: List[Payment]
+    generated_at: Optional[datetime] = None
+    age_seconds: float = 0.0
 
 # ==================== AUTH HELPERS ====================
 
@@ -183,19 +311,492 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
-async def get_current_admin(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def run_password_work(func, *args):
+    global password_pending
+    if password_pending >= PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE:
+        raise HTTPException(status_code=503, detail="Too many authentication requests", headers={"Retry-After": "1"})
+    password_pending += 1
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, func, *args)
+    finally:
+        password_pending -= 1
+
+async def verify_password_async(plain_password, hashed_password) -> bool:
+    return await run_password_work(verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password) -> str:
+    return await run_password_work(get_password_hash, password)
+
+def client_ip(request: Request) -> str:
+    # The rightmost entries were appended by our own proxies and cannot be spoofed
+    forwarded = [ip.strip() for ip in request.headers.get("x-forwarded-for", "").split(",") if ip.strip()]
+    if TRUSTED_PROXY_HOPS and forwarded:
+        return forwarded[-min(TRUSTED_PROXY_HOPS, len(forwarded))]
+    return request.client.host if request.client else "unknown"
+
+def check_login_throttle(email: str, ip: str):
+    retry_after = max(login_email_throttle.retry_after(email), login_ip_throttle.retry_after(ip))
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many failed login attempts, try again later",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+async def get_current_admin(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    token = credentials.credentials
+    email = token_cache.get(token)
+    if email is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            email: str = payload.get("sub")
+            if email is None:
+                raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+        except jwt.PyJWTError:
             raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-    except jwt.PyJWTError:
-        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-    
-    admin = await db.admins.find_one({"email": email}, {"_id": 0})
+        # Never keep a token in the cache past its own expiration
+        exp = payload.get("exp")
+        token_cache.set(token, email, ttl=exp - datetime.now(timezone.utc).timestamp() if exp else None)
+
+    admin = admin_cache.get(email)
     if admin is None:
-        raise HTTPException(status_code=401, detail="Admin not found")
-    return Admin(**admin)
+        admin = await db.admins.find_one({"email": email}, {"_id": 0})
+        if admin is None:
+            raise HTTPException(status_code=401, detail="Admin not found")
+        admin = Admin(**admin)
+        admin_cache.set(email, admin)
+    return admin
+
+def invalidate_admin_cache(email: str):
+    admin_cache.invalidate(email)
+    token_cache.invalidate_where(lambda token, cached_email: cached_email == email)
+
+# ==================== PAGINATION HELPERS ====================
+
+def encode_cursor(values: list) -> str:
+    # datetimes are tagged so the cursor compares with the same BSON type it came from
+    raw = [{"$date": v.isoformat()} if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(raw, separators=(",", ":")).encode()).decode()
+
+def decode_cursor_value(value):
+    if isinstance(value, dict):
+        # Only the tagged datetime is accepted; any other object would reach the
+        # keyset $or as a query operator
+        if list(value) != ["$date"] or not isinstance(value["$date"], str):
+            raise ValueError("unexpected object in cursor")
+        return datetime.fromisoformat(value["$date"])
+    if value is not None and not isinstance(value, (str, int, float, bool)):
+        raise ValueError("unexpected value in cursor")
+    return value
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(raw, list):
+            raise ValueError("cursor is not a list")
+        return [decode_cursor_value(v) for v in raw]
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset_filter(sort_field: str, cursor: Optional[str], descending: bool) -> dict:
+    # Seek past the last (sort_field, id) pair instead of skipping documents
+    if not cursor:
+        return {}
+    values = decode_cursor(cursor)
+    if len(values) != 2 or not isinstance(values[1], str):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    last_value, last_id = values
+    op = "$lt" if descending else "$gt"
+    return {"$or": [
+        {sort_field: {op: last_value}},
+        {sort_field: last_value, "id": {op: last_id}},
+    ]}
+
+def date_range_filter(field: str, date_from: Optional[datetime], date_to: Optional[datetime]) -> dict:
+    # ?date_from=2026-10-01 arrives naive; it means the business day, as in /reports/revenue
+    bounds = {}
+    if date_from is not None:
+        bounds['$gte'] = as_aware_datetime(date_from)
+    if date_to is not None:
+        bounds['$lt'] = as_aware_datetime(date_to)
+    return {field: bounds} if bounds else {}
+
+async def fetch_page(collection, query: dict, projection: dict, sort_field: str,
+                     limit: int, cursor: Optional[str], descending: bool):
+    # Fetches one extra document to know whether another page follows
+    query = {**query, **keyset_filter(sort_field, cursor, descending)}
+    direction = DESCENDING if descending else ASCENDING
+    docs = await collection.find(query, projection) \
+        .sort([(sort_field, direction), ("id", direction)]) \
+        .limit(limit + 1) \
+        .to_list(limit + 1)
+    
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor([docs[-1][sort_field], docs[-1]['id']])
+    return docs, next_cursor
+
+def parse_fields(fields: Optional[str], model, required: List[str]) -> dict:
+    if not fields:
+        # Only the model's fields, so internal bookkeeping fields never leak
+        return model_projection(model)
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in requested if f not in model.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    projection = {"_id": 0}
+    for field in list(requested) + required:
+        projection[field] = 1
+    return projection
+
+# ==================== FAST JSON ====================
+
+class FastJSONResponse(ORJSONResponse):
+    def render(self, content) -> bytes:
+        # OPT_UTC_Z renders UTC datetimes exactly like Pydantic does ("...Z")
+        return orjson.dumps(content, option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS)
+
+def model_projection(model) -> dict:
+    return {"_id": 0, **{name: 1 for name in model.model_fields}}
+
+def model_defaults(model) -> dict:
+    return {
+        name: field.default
+        for name, field in model.model_fields.items()
+        if not field.is_required() and field.default_factory is None
+    }
+
+# List endpoints trust documents written by this API: Mongo projects the model's
+# fields, missing defaults are filled in and orjson encodes the rows directly,
+# skipping Pydantic validation and serialization of every row
+USER_PROJECTION, USER_DEFAULTS = model_projection(User), model_defaults(User)
+DNS_PROJECTION, DNS_DEFAULTS = model_projection(DNS), model_defaults(DNS)
+PAYMENT_PROJECTION, PAYMENT_DEFAULTS = model_projection(Payment), model_defaults(Payment)
+
+def fast_list_response(docs: List[dict], defaults: dict) -> FastJSONResponse:
+    return FastJSONResponse([{**defaults, **doc} for doc in docs])
+
+# ==================== REFERENCE DATA ====================
+
+# Settings, DNS servers and templates change rarely but are read on hot paths.
+# They are kept in memory, loaded at startup and updated by the routes that write
+# them. Every write also bumps a version document in Mongo; workers poll it and
+# reload when it moves, so changes made by other workers show up within seconds.
+REFERENCE_POLL_SECONDS = float(os.environ.get('REFERENCE_POLL_SECONDS', '2'))
+# Full reload as a backstop for changes made outside the API
+REFERENCE_REFRESH_SECONDS = float(os.environ.get('REFERENCE_REFRESH_SECONDS', '300'))
+REFERENCE_VERSION_ID = "reference"
+
+class ReferenceData:
+    def __init__(self):
+        self.settings: Optional[dict] = None
+        self.dns: Dict[str, dict] = {}
+        self.templates: Dict[str, dict] = {}
+        self.version: Optional[int] = None
+        self.loaded_at: Optional[datetime] = None
+
+    async def stored_version(self) -> Optional[int]:
+        doc = await db.versions.find_one({"_id": REFERENCE_VERSION_ID})
+        return doc['version'] if doc else None
+
+    async def load(self):
+        # The version is read first: a change landing mid-load triggers another one
+        self.version = await self.stored_version()
+        settings, servers, templates = await asyncio.gather(
+            db.settings.find_one({"id": "system_settings"}, {"_id": 0}),
+            db.dns_servers.find({}, {"_id": 0}).to_list(None),
+            db.templates.find({}, {"_id": 0}).to_list(None),
+        )
+        self.settings = settings
+        self.replace_dns(servers)
+        self.replace_templates(templates)
+        self.loaded_at = datetime.now(timezone.utc)
+
+    async def sync(self):
+        if await self.stored_version() != self.version:
+            await self.load()
+
+    async def changed(self):
+        await db.versions.update_one({"_id": REFERENCE_VERSION_ID}, {"$inc": {"version": 1}}, upsert=True)
+
+    async def get_settings(self) -> Optional[dict]:
+        if self.settings is None:
+            self.settings = await db.settings.find_one({"id": "system_settings"}, {"_id": 0})
+        return self.settings
+
+    async def get_dns(self, dns_id: str, fresh: bool = False) -> Optional[dict]:
+        if fresh:
+            # Values derived from the DNS URL are stored, so they must not come
+            # from a copy another worker has already changed
+            await self.sync()
+        dns = self.dns.get(dns_id)
+        if dns is None:
+            # Read-through: the server may have been created on another worker
+            dns = await db.dns_servers.find_one({"id": dns_id}, {"_id": 0})
+            if dns:
+                self.dns[dns_id] = dns
+        return dns
+
+    def replace_dns(self, servers: List[dict]):
+        self.dns = {server['id']: server for server in servers}
+
+    def replace_templates(self, templates: List[dict]):
+        self.templates = {template['id']: template for template in templates}
+
+reference = ReferenceData()
+
+async def reference_refresher():
+    while True:
+        await asyncio.sleep(REFERENCE_POLL_SECONDS)
+        try:
+            if (datetime.now(timezone.utc) - reference.loaded_at).total_seconds() >= REFERENCE_REFRESH_SECONDS:
+                await reference.load()
+            else:
+                await reference.sync()
+        except Exception as e:
+            logger.error("Reference data refresh failed: %s", e)
+
+def build_lista_m3u(dns_url: str, username: str, password: str) -> str:
+    return f"{dns_url}/get.php?username={username}&password={password}&type=m3u_plus&output=mpegts"
+
+def lista_m3u_expression(dns_url: str) -> dict:
+    # Server-side equivalent of build_lista_m3u
+    return {"$concat": [
+        {"$literal": f"{dns_url}/get.php?username="}, "$username",
+        "&password=", "$password",
+        "&type=m3u_plus&output=mpegts",
+    ]}
+
+# ==================== BACKGROUND JOBS ====================
+
+# Long running jobs keep their progress in Mongo so any replica can report it
+async def create_job(job_type: str, params: dict, total: int = 0) -> dict:
+    job = {
+        "id": str(uuid.uuid4()),
+        "type": job_type,
+        "status": "running",
+        "params": params,
+        "total": total,
+        "processed": 0,
+        "started_at": datetime.now(timezone.utc),
+        "finished_at": None,
+        "error": None,
+    }
+    await db.jobs.insert_one(job)
+    job.pop('_id', None)
+    return job
+
+async def update_job(job_id: str, set_fields: Optional[dict] = None, inc: Optional[dict] = None):
+    update = {}
+    if set_fields:
+        update['$set'] = set_fields
+    if inc:
+        update['$inc'] = inc
+    if update:
+        await db.jobs.update_one({"id": job_id}, update)
+
+# Identifies this process when it holds a scheduler lease
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+async def acquire_lease(name: str, ttl_seconds: float) -> bool:
+    # Only one replica/worker runs a periodic pass; the holder renews it each time
+    now = datetime.now(timezone.utc)
+    try:
+        await db.locks.find_one_and_update(
+            {"_id": name, "$or": [{"expires_at": {"$lt": now}}, {"owner": INSTANCE_ID}]},
+            {"$set": {"owner": INSTANCE_ID, "expires_at": now + timedelta(seconds=ttl_seconds)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def finish_job(job_id: str, error: Optional[str] = None):
+    await update_job(job_id, {
+        "status": "failed" if error else "completed",
+        "finished_at": datetime.now(timezone.utc),
+        "error": error,
+    })
+
+# ==================== M3U VALIDATION ====================
+
+VALIDATION_CONCURRENCY = int(os.environ.get('VALIDATION_CONCURRENCY', '50'))
+VALIDATION_BATCH_SIZE = 500
+
+M3U_SAMPLE_ENTRIES = int(os.environ.get('M3U_SAMPLE_ENTRIES', '5'))
+M3U_SAMPLE_BYTES = int(os.environ.get('M3U_SAMPLE_BYTES', '65536'))
+
+async def check_m3u(url: str, estimate_channels: bool = False, limit: Optional[asyncio.Semaphore] = None) -> dict:
+    # Playlists can be tens of MB: stream the body, check the header and the
+    # first entries, then drop the connection instead of downloading it all
+    started = time.perf_counter()
+    result = {"valid": False, "status": None, "message": "", "error": None,
+              "entries_sampled": 0, "bytes_read": 0, "estimated_channels": None}
+    try:
+        # A job-wide limit is taken only once the panel has a free slot, so one busy
+        # panel cannot hold it while the others sit idle
+        async with http_clients.panel_slot(url), limit or contextlib.nullcontext():
+            started = time.perf_counter()
+            async with http_clients.panels.stream("GET", url) as response:
+                result['status'] = response.status_code
+                if response.status_code != 200:
+                    result['message'] = f"HTTP {response.status_code}"
+                else:
+                    sample = bytearray()
+                    complete = True
+                    async for chunk in response.aiter_bytes():
+                        sample += chunk
+                        entries = sample.count(b"#EXTINF")
+                        if len(sample) >= M3U_SAMPLE_BYTES or (not estimate_channels and entries >= M3U_SAMPLE_ENTRIES):
+                            complete = False
+                            break
+                    entries = sample.count(b"#EXTINF")
+                    result.update(entries_sampled=entries, bytes_read=response.num_bytes_downloaded)
+                    if not sample.lstrip(b"\xef\xbb\xbf \t\r\n").startswith(b"#EXTM3U"):
+                        result['message'] = "Response is not an M3U playlist"
+                    else:
+                        result.update(valid=True, message="M3U list is accessible")
+                        if estimate_channels:
+                            total_bytes = response.headers.get("content-length")
+                            if complete:
+                                result['estimated_channels'] = entries
+                            elif total_bytes and total_bytes.isdigit() and response.num_bytes_downloaded:
+                                ratio = int(total_bytes) / response.num_bytes_downloaded
+                                result['estimated_channels'] = int(entries * ratio)
+    except Exception as e:
+        result.update(message=str(e), error=type(e).__name__)
+    result['latency_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    result['checked_at'] = datetime.now(timezone.utc)
+    return result
+
+async def run_validation_job(job_id: str, query: dict, estimate_channels: bool = False):
+    slots = asyncio.Semaphore(VALIDATION_CONCURRENCY)
+    writes = []
+    counters = {"processed": 0, "valid": 0, "invalid": 0}
+
+    async def validate_one(user, pending):
+        try:
+            result = await check_m3u(user['lista_m3u'], estimate_channels, limit=slots)
+        finally:
+            pending.release()
+        writes.append(UpdateOne({"id": user['id']}, {"$set": {"last_validation": result}}))
+        counters['valid' if result['valid'] else 'invalid'] += 1
+        counters['processed'] += 1
+
+    async def flush():
+        batch, writes[:] = list(writes), []
+        if batch:
+            await db.users.bulk_write(batch, ordered=False)
+        await update_job(job_id, dict(counters))
+
+    async def validate_dns(dns_id):
+        # One cursor per DNS keeps every panel busy: a single cursor returning users
+        # grouped by panel would queue the whole job behind one host's slots
+        pending = asyncio.Semaphore(PANEL_HOST_CONCURRENCY)
+        running = set()
+        cursor = db.users.find({"$and": [query, {"dns_id": dns_id}]}, {"_id": 0, "id": 1, "lista_m3u": 1}) \
+            .batch_size(VALIDATION_BATCH_SIZE)
+        async for user in cursor:
+            await pending.acquire()
+            task = asyncio.create_task(validate_one(user, pending))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            if len(writes) >= VALIDATION_BATCH_SIZE:
+                await flush()
+        await asyncio.gather(*running)
+
+    try:
+        dns_ids = await db.users.distinct("dns_id", query)
+        await asyncio.gather(*(validate_dns(dns_id) for dns_id in dns_ids))
+        await flush()
+        await finish_job(job_id)
+    except Exception as e:
+        logger.exception("Validation job %s failed", job_id)
+        await finish_job(job_id, error=str(e))
+
+# ==================== DNS HEALTH MONITOR ====================
+
+DNS_PROBE_INTERVAL = float(os.environ.get('DNS_PROBE_INTERVAL', '60'))
+DNS_PROBE_CONCURRENCY = int(os.environ.get('DNS_PROBE_CONCURRENCY', '10'))
+DNS_HEALTH_RETENTION_DAYS = int(os.environ.get('DNS_HEALTH_RETENTION_DAYS', '7'))
+
+async def probe_dns(url: str) -> dict:
+    # Any HTTP answer below 500 means the panel is up; the body is never read
+    started = time.perf_counter()
+    result = {"up": False, "status": None, "error": None}
+    try:
+        async with http_clients.panel_slot(url):
+            # Time spent queued behind a bulk validation is not the panel's latency
+            started = time.perf_counter()
+            async with http_clients.panels.stream("GET", url) as response:
+                result.update(up=response.status_code < 500, status=response.status_code)
+    except Exception as e:
+        result['error'] = str(e) or type(e).__name__
+    result['latency_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    result['checked_at'] = datetime.now(timezone.utc)
+    return result
+
+async def record_dns_probe(dns_id: str, result: dict):
+    # One document per server per hour keeps the history compact
+    hour = result['checked_at'].replace(minute=0, second=0, microsecond=0)
+    update = {"$inc": {"samples": 1, "up": int(result['up'])}, "$set": {"last": result}}
+    if result['up']:
+        update['$push'] = {"latencies": result['latency_ms']}
+    await asyncio.gather(
+        db.dns_health.update_one(
+            {"_id": f"{dns_id}:{hour.isoformat()}"},
+            {**update, "$setOnInsert": {"dns_id": dns_id, "hour": hour}},
+            upsert=True,
+        ),
+        db.dns_servers.update_one({"id": dns_id}, {"$set": {"health": result}}),
+    )
+
+async def probe_all_dns():
+    servers = await db.dns_servers.find({"active": True}, {"_id": 0, "id": 1, "url": 1}).to_list(None)
+    slots = asyncio.Semaphore(DNS_PROBE_CONCURRENCY)
+
+    async def probe_one(server):
+        async with slots:
+            result = await probe_dns(server['url'])
+        await record_dns_probe(server['id'], result)
+
+    await asyncio.gather(*(probe_one(server) for server in servers))
+
+async def dns_health_monitor():
+    while True:
+        try:
+            if await acquire_lease("dns_health_monitor", DNS_PROBE_INTERVAL * 2):
+                await probe_all_dns()
+        except Exception as e:
+            logger.error("DNS health probe failed: %s", e)
+        await asyncio.sleep(DNS_PROBE_INTERVAL)
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    # Nearest-rank percentile
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+def summarize_dns_buckets(buckets: List[dict]) -> dict:
+    samples = sum(b['samples'] for b in buckets)
+    up = sum(b['up'] for b in buckets)
+    latencies = [ms for b in buckets for ms in b.get('latencies', [])]
+    return {
+        "samples": samples,
+        "uptime": round(up / samples, 4) if samples else None,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+    }
+
+async def load_dns_buckets(hours: int, dns_id: Optional[str] = None) -> List[dict]:
+    since = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(hours=hours - 1)
+    query = {"hour": {"$gte": since}}
+    if dns_id is not None:
+        query['dns_id'] = dns_id
+    return await db.dns_health.find(query, {"_id": 0, "last": 0}).sort("hour", ASCENDING).to_list(None)
 
 # ==================== AUTH ROUTES ====================
 
@@ -209,25 +810,32 @@ async def register_admin(admin_data: AdminCreate):
     admin = Admin(
         email=admin_data.email,
         name=admin_data.name,
-        password_hash=get_password_hash(admin_data.password)
+        password_hash=await get_password_hash_async(admin_data.password)
     )
     
     doc = admin.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.admins.insert_one(doc)
+    try:
+        await db.admins.insert_one(doc)
+    except DuplicateKeyError:
+        # Unique index on admins.email closes the find-then-insert race
+        raise HTTPException(status_code=400, detail="Email already registered")
+    invalidate_admin_cache(admin.email)
     
     access_token = create_access_token(data={"sub": admin.email})
     return {"access_token": access_token, "token_type": "bearer"}
 
 @api_router.post("/auth/login", response_model=Token)
-async def login_admin(login_data: AdminLogin):
-    admin = await db.admins.find_one({"email": login_data.email}, {"_id": 0})
-    if not admin:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
+async def login_admin(login_data: AdminLogin, request: Request):
+    email, ip = login_data.email.lower(), client_ip(request)
+    check_login_throttle(email, ip)
     
-    if not verify_password(login_data.password, admin['password_hash']):
+    admin = await db.admins.find_one({"email": login_data.email}, {"_id": 0})
+    if not admin or not await verify_password_async(login_data.password, admin['password_hash']):
+        login_email_throttle.record_failure(email)
+        login_ip_throttle.record_failure(ip)
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
+    login_email_throttle.reset(email)
     access_token = create_access_token(data={"sub": admin['email']})
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -239,16 +847,29 @@ async def get_current_admin_info(current_admin: Admin = Depends(get_current_admi
 
 @api_router.get("/users", response_model=List[User])
 async def get_users(current_admin: Admin = Depends(get_current_admin)):
-    users = await db.users.find({}, {"_id": 0}).to_list(1000)
-    for user in users:
-        if isinstance(user.get('created_at'), str):
-            user['created_at'] = datetime.fromisoformat(user['created_at'])
-        # Suporte para campo antigo expire_date
-        if 'expire_date' in user and 'expires_at' not in user:
-            user['expires_at'] = user['expire_date']
-        if isinstance(user.get('expires_at'), str):
-            user['expires_at'] = datetime.fromisoformat(user['expires_at'])
-    return users
+    users = await db.users.find({}, USER_PROJECTION).to_list(1000)
+    return fast_list_response(users, USER_DEFAULTS)
+
+@api_router.get("/users/page", response_model=UserPage)
+async def get_users_page(
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    dns_id: Optional[str] = None,
+    active: Optional[bool] = None,
+    order: str = Query("desc", pattern="^(asc|desc)$"),
+    fields: Optional[str] = Query(None, description="Comma separated User fields to return"),
+    current_admin: Admin = Depends(get_current_admin)
+):
+    query = {}
+    if dns_id is not None:
+        query['dns_id'] = dns_id
+    if active is not None:
+        query['active'] = active
+
+    projection = parse_fields(fields, User, required=['id', 'created_at'])
+    users, next_cursor = await fetch_page(db.users, query, projection, 'created_at', limit, cursor, order == "desc")
+
+    return FastJSONResponse({"items": users, "next_cursor": next_cursor})
 
 @api_router.post("/users", response_model=User)
 async def create_user(user_data: UserCreate, current_admin: Admin = Depends(get_current_admin)):
@@ -258,11 +879,11 @@ async def create_user(user_data: UserCreate, current_admin: Admin = Depends(get_
         raise HTTPException(status_code=400, detail="Username already exists")
     
     # Get DNS to build lista_m3u
-    dns = await db.dns_servers.find_one({"id": user_data.dns_id}, {"_id": 0})
+    dns = await reference.get_dns(user_data.dns_id, fresh=True)
     if not dns:
         raise HTTPException(status_code=404, detail="DNS not found")
     
-    lista_m3u = f"{dns['url']}/get.php?username={user_data.username}&password={user_data.password}&type=m3u_plus&output=mpegts"
+    lista_m3u = build_lista_m3u(dns['url'], user_data.username, user_data.password)
     
     user = User(
         username=user_data.username,
@@ -279,9 +900,13 @@ async def create_user(user_data: UserCreate, current_admin: Admin = Depends(get_
     )
     
     doc = user.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['expires_at'] = doc['expires_at'].isoformat()
-    await db.users.insert_one(doc)
+    doc['search_keys'] = user_search_keys(doc)
+    try:
+        await db.users.insert_one(doc)
+    except DuplicateKeyError:
+        # Unique index on users.username closes the find-then-insert race
+        raise HTTPException(status_code=400, detail="Username already exists")
+    await apply_user_stats(None, doc)
     
     return user
 
@@ -299,35 +924,53 @@ async def update_user(user_id: str, user_data: UserUpdate, current_admin: Admin
         username = update_data.get('username', existing['username'])
         password = update_data.get('password', existing['password'])
         
-        dns = await db.dns_servers.find_one({"id": dns_id}, {"_id": 0})
+        dns = await reference.get_dns(dns_id, fresh=True)
         if dns:
-            update_data['lista_m3u'] = f"{dns['url']}/get.php?username={username}&password={password}&type=m3u_plus&output=mpegts"
+            update_data['lista_m3u'] = build_lista_m3u(dns['url'], username, password)
     
-    if 'expires_at' in update_data:
-        update_data['expires_at'] = update_data['expires_at'].isoformat()
+    if any(k in update_data for k in SEARCH_KEY_FIELDS):
+        update_data['search_keys'] = user_search_keys({**existing, **update_data})
     
-    await db.users.update_one({"id": user_id}, {"$set": update_data})
+    try:
+        await db.users.update_one({"id": user_id}, {"$set": update_data})
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Username already exists")
     
     updated_user = await db.users.find_one({"id": user_id}, {"_id": 0})
-    if isinstance(updated_user.get('created_at'), str):
-        updated_user['created_at'] = datetime.fromisoformat(updated_user['created_at'])
-    # Suporte para campo antigo
-    if 'expire_date' in updated_user and 'expires_at' not in updated_user:
-        updated_user['expires_at'] = updated_user['expire_date']
-    if isinstance(updated_user.get('expires_at'), str):
-        updated_user['expires_at'] = datetime.fromisoformat(updated_user['expires_at'])
+    await apply_user_stats(existing, updated_user)
+    invalidate_portal(username=existing['username'])
+    invalidate_portal(username=updated_user['username'])
     
     return User(**updated_user)
 
 @api_router.delete("/users/{user_id}")
 async def delete_user(user_id: str, current_admin: Admin = Depends(get_current_admin)):
-    result = await db.users.delete_one({"id": user_id})
-    if result.deleted_count == 0:
+    deleted = await db.users.find_one_and_delete(
+        {"id": user_id}, {"_id": 0, "username": 1, "active": 1, "expires_at": 1}
+    )
+    if deleted is None:
         raise HTTPException(status_code=404, detail="User not found")
+    await apply_user_stats(deleted, None)
+    invalidate_portal(username=deleted['username'])
     return {"message": "User deleted successfully"}
 
+@api_router.post("/users/validate", status_code=202)
+async def validate_users(request: BulkValidateRequest, current_admin: Admin = Depends(get_current_admin)):
+    query = {"lista_m3u": {"$nin": [None, ""]}}
+    if request.user_ids is not None:
+        query['id'] = {"$in": request.user_ids}
+    if request.dns_id is not None:
+        query['dns_id'] = request.dns_id
+    if request.active is not None:
+        query['active'] = request.active
+    
+    total = await db.users.count_documents(query)
+    job = await create_job("validate_m3u", request.model_dump(exclude_none=True), total=total)
+    start_background(run_validation_job(job['id'], query, request.estimate_channels))
+    return job
+
 @api_router.post("/users/{user_id}/validate")
-async def validate_m3u(user_id: str, current_admin: Admin = Depends(get_current_admin)):
+async def validate_m3u(user_id: str, estimate_channels: bool = False, current_admin: Admin = Depends(get_current_admin)):
     user = await db.users.find_one({"id": user_id}, {"_id": 0})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -335,25 +978,342 @@ async def validate_m3u(user_id: str, current_admin: Admin = Depends(get_current_
     if not user.get('lista_m3u'):
         raise HTTPException(status_code=400, detail="No M3U list configured")
     
+    result = await check_m3u(user['lista_m3u'], estimate_channels)
+    await db.users.update_one({"id": user_id}, {"$set": {"last_validation": result}})
+    return result
+
+# ==================== USER SEARCH ====================
+
+# Each user keeps a normalized search_keys array (lowercase, no accents, phone and
+# MAC reduced to digits/hex) so typeahead is an anchored regex on a multikey index
+SEARCH_KEY_FIELDS = ("username", "name", "phone", "mac_address")
+SEARCH_FIELDS = ["id", "username", "name", "phone", "mac_address", "dns_id", "expires_at", "active"]
+SEARCH_MAX_TIME_MS = int(os.environ.get('SEARCH_MAX_TIME_MS', '500'))
+
+def normalize_search_text(value: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", value)
+    return " ".join("".join(c for c in decomposed if not unicodedata.combining(c)).lower().split())
+
+def user_search_keys(user: dict) -> List[str]:
+    keys = set()
+    if user.get('username'):
+        keys.add(normalize_search_text(user['username']))
+    if user.get('name'):
+        name = normalize_search_text(user['name'])
+        keys.add(name)
+        keys.update(name.split())
+    if user.get('phone'):
+        digits = re.sub(r"\D", "", user['phone'])
+        keys.add(digits)
+        # Numbers stored with the country code are also found by DDD + number,
+        # and either form by the number alone
+        national = digits[2:] if digits.startswith("55") and len(digits) > 11 else digits
+        keys.add(national)
+        if len(national) in (10, 11):
+            keys.add(national[2:])
+    if user.get('mac_address'):
+        keys.add(re.sub(r"[^0-9a-f]", "", user['mac_address'].lower()))
+    return sorted(key for key in keys if key)
+
+def search_terms(q: str) -> List[str]:
+    terms = {normalize_search_text(q)}
+    digits = re.sub(r"\D", "", q)
+    if len(digits) >= 2:
+        terms.add(digits)
+    if re.fullmatch(r"[0-9a-fA-F]{2}([:.-]?[0-9a-fA-F]{1,2})+[:.-]?", q.strip()):
+        terms.add(re.sub(r"[^0-9a-f]", "", q.lower()))
+    return sorted(term for term in terms if term)
+
+def search_patterns(terms: List[str], prefix: bool) -> List[Regex]:
+    # Anchored patterns are answered from the index bounds; "contains" scans the keys.
+    # Regex carries no flags: re.compile patterns go out with the "u" option, and the
+    # planner only builds prefix bounds for regexes without options
+    anchor = "^" if prefix else ""
+    return [Regex(anchor + re.escape(term)) for term in terms]
+
+@api_router.get("/users/search")
+async def search_users(
+    q: str = Query(..., min_length=1, max_length=100),
+    mode: str = Query("prefix", pattern="^(prefix|contains)$"),
+    limit: int = Query(10, ge=1, le=50),
+    dns_id: Optional[str] = None,
+    active: Optional[bool] = None,
+    fields: Optional[str] = Query(None, description="Comma separated User fields to return"),
+    current_admin: Admin = Depends(get_current_admin)
+):
+    terms = search_terms(q)
+    if not terms:
+        return FastJSONResponse([])
+    query = {"search_keys": {"$in": search_patterns(terms, prefix=mode == "prefix")}}
+    if dns_id is not None:
+        query['dns_id'] = dns_id
+    if active is not None:
+        query['active'] = active
+    
+    projection = parse_fields(fields or ",".join(SEARCH_FIELDS), User, required=['id'])
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(user['lista_m3u'])
-            if response.status_code == 200:
-                return {"valid": True, "message": "M3U list is accessible"}
-            else:
-                return {"valid": False, "message": f"HTTP {response.status_code}"}
+        users = await db.users.find(query, projection).max_time_ms(SEARCH_MAX_TIME_MS).limit(limit).to_list(limit)
+    except ExecutionTimeout:
+        raise HTTPException(status_code=504, detail="Search took too long, refine the query")
+    return FastJSONResponse(users)
+
+async def backfill_search_keys():
+    # Users created before search_keys existed get them once, in batches
+    if await db.migrations.find_one({"_id": "search_keys"}):
+        return
+    if not await acquire_lease("search_keys", 3600):
+        return
+    try:
+        updated = 0
+        cursor = db.users.find(
+            {"search_keys": {"$exists": False}},
+            {"_id": 1, **{field: 1 for field in SEARCH_KEY_FIELDS}},
+        ).batch_size(1000)
+        writes = []
+        async for user in cursor:
+            writes.append(UpdateOne({"_id": user['_id']}, {"$set": {"search_keys": user_search_keys(user)}}))
+            if len(writes) >= 1000:
+                updated += (await db.users.bulk_write(writes, ordered=False)).modified_count
+                writes = []
+        if writes:
+            updated += (await db.users.bulk_write(writes, ordered=False)).modified_count
+        await db.migrations.insert_one({"_id": "search_keys", "done_at": datetime.now(timezone.utc)})
+        logger.info("Built search keys for %d users", updated)
     except Exception as e:
-        return {"valid": False, "message": str(e)}
+        logger.error("Search keys backfill failed: %s", e)
+
+# ==================== BULK USER OPERATIONS ====================
+
+def bulk_user_query(request: BulkUserFilter) -> dict:
+    query = {}
+    if request.user_ids is not None:
+        query['id'] = {"$in": request.user_ids}
+    if request.dns_id is not None:
+        query['dns_id'] = request.dns_id
+    if request.active is not None:
+        query['active'] = request.active
+    if not query:
+        raise HTTPException(status_code=400, detail="Provide user_ids, dns_id or active to select users")
+    return query
+
+async def run_bulk_update(query: dict, update) -> dict:
+    # A single update_many replaces one find/update/find round trip per user
+    result = await db.users.update_many(query, update)
+    if result.modified_count:
+        portal_cache.clear()
+        start_background(rebuild_stats_snapshot())
+    return {"matched": result.matched_count, "modified": result.modified_count}
+
+@api_router.post("/users/bulk/renew")
+async def bulk_renew_users(request: BulkRenewRequest, current_admin: Admin = Depends(get_current_admin)):
+    start = "$expires_at"
+    if request.from_now_if_expired:
+        start = {"$max": ["$expires_at", "$$NOW"]}
+    return await run_bulk_update(bulk_user_query(request), [
+        {"$set": {"expires_at": {"$dateAdd": {"startDate": start, "unit": "day", "amount": request.days}}}},
+    ])
+
+@api_router.post("/users/bulk/active")
+async def bulk_set_active(request: BulkActiveRequest, current_admin: Admin = Depends(get_current_admin)):
+    return await run_bulk_update(bulk_user_query(request), {"$set": {"active": request.set_active}})
+
+@api_router.post("/users/bulk/dns")
+async def bulk_change_dns(request: BulkDNSRequest, current_admin: Admin = Depends(get_current_admin)):
+    dns = await reference.get_dns(request.target_dns_id, fresh=True)
+    if not dns:
+        raise HTTPException(status_code=404, detail="DNS not found")
+    return await run_bulk_update(bulk_user_query(request), [
+        {"$set": {"dns_id": dns['id'], "lista_m3u": lista_m3u_expression(dns['url'])}},
+    ])
+
+# ==================== USER IMPORT ====================
+
+IMPORT_BATCH_SIZE = 1000
+IMPORT_MAX_ERRORS = 1000
+
+class ImportFileError(Exception):
+    pass
+
+IMPORT_SNIFF_BYTES = 64 * 1024
+
+def detect_csv_encoding(file) -> str:
+    # Excel in pt-BR saves CSV as cp1252; anything that is not valid UTF-8 is read that way
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        while chunk := file.read(1024 * 1024):
+            decoder.decode(chunk)
+        decoder.decode(b"", final=True)
+        return "utf-8-sig"
+    except UnicodeDecodeError:
+        return "cp1252"
+    finally:
+        file.seek(0)
+
+def iter_csv_rows(file):
+    text = io.TextIOWrapper(file, encoding=detect_csv_encoding(file), newline="")
+    sample = text.read(IMPORT_SNIFF_BYTES)
+    text.seek(0)
+    try:
+        # Only whole lines, so a row cut by the sample size does not confuse the sniffer
+        delimiter = csv.Sniffer().sniff(sample.rpartition("\n")[0] or sample, delimiters=",;\t").delimiter
+    except csv.Error:
+        delimiter = ","
+    reader = csv.DictReader(text, delimiter=delimiter)
+    for row in reader:
+        yield reader.line_num, row
+
+def iter_xlsx_rows(file):
+    try:
+        from openpyxl import load_workbook
+        from openpyxl.utils.exceptions import InvalidFileException
+    except ImportError:
+        raise HTTPException(status_code=400, detail="XLSX import requires openpyxl")
+    try:
+        # read_only streams the sheet instead of loading the whole workbook
+        workbook = load_workbook(file, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = [str(cell).strip() if cell is not None else "" for cell in next(rows, [])]
+            for number, values in enumerate(rows, start=2):
+                yield number, dict(zip(header, values))
+        finally:
+            workbook.close()
+    # A corrupt workbook fails inside zipfile or the XML parser (SyntaxError) rather than openpyxl
+    except (zipfile.BadZipFile, InvalidFileException, KeyError, ValueError, SyntaxError) as e:
+        raise ImportFileError(f"not a valid xlsx workbook ({type(e).__name__}: {e})")
+
+def clean_import_row(row: dict) -> dict:
+    cleaned = {}
+    for key, value in row.items():
+        if not key:
+            continue
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if value is not None and not isinstance(value, datetime):
+            value = str(value).strip() or None
+        if value is not None:
+            cleaned[key.strip().lower()] = value
+    return cleaned
+
+def build_import_doc(row: dict, dns_by_key: Dict[str, dict]) -> dict:
+    user_data = UserCreate(**row)
+    dns = dns_by_key.get(user_data.dns_id) or dns_by_key.get(user_data.dns_id.strip().lower())
+    if not dns:
+        raise ValueError("DNS not found")
+    user = User(
+        username=user_data.username,
+        password=user_data.password,
+        dns_id=dns['id'],
+        name=user_data.name,
+        phone=user_data.phone,
+        mac_address=user_data.mac_address,
+        expires_at=user_data.expires_at,
+        lista_m3u=build_lista_m3u(dns['url'], user_data.username, user_data.password),
+        pin=user_data.pin or "0000",
+        plan_price=user_data.plan_price,
+        pay_url=user_data.pay_url
+    )
+    doc = user.model_dump()
+    doc['search_keys'] = user_search_keys(doc)
+    return doc
+
+@api_router.post("/users/import")
+async def import_users(
+    file: UploadFile = File(...),
+    file_format: Optional[str] = Query(None, alias="format", pattern="^(csv|xlsx)$"),
+    current_admin: Admin = Depends(get_current_admin)
+):
+    file_format = file_format or ("xlsx" if (file.filename or "").lower().endswith(".xlsx") else "csv")
+    rows = iter_xlsx_rows(file.file) if file_format == "xlsx" else iter_csv_rows(file.file)
+    
+    # dns_id may hold either the DNS id or its title
+    servers = await db.dns_servers.find({}, {"_id": 0, "id": 1, "title": 1, "url": 1}).to_list(None)
+    dns_by_key = {server['id']: server for server in servers}
+    dns_by_key.update({server['title'].strip().lower(): server for server in servers})
+    
+    inserted, failed, errors, parse_error = 0, 0, [], None
+    
+    def add_error(row_number, error):
+        nonlocal failed
+        failed += 1
+        if len(errors) < IMPORT_MAX_ERRORS:
+            errors.append({"row": row_number, "error": error})
+    
+    while True:
+        # Parsing runs in a worker thread, one batch at a time, so neither the
+        # event loop nor memory has to hold the whole file
+        try:
+            batch = await asyncio.to_thread(lambda: list(itertools.islice(rows, IMPORT_BATCH_SIZE)))
+        except (csv.Error, UnicodeDecodeError, ImportFileError) as e:
+            if not inserted and not failed:
+                raise HTTPException(status_code=400, detail=f"Invalid file: {e}")
+            # Earlier batches are already stored; report them along with where parsing stopped
+            parse_error = f"Invalid file: {e}"
+            break
+        if not batch:
+            break
+        
+        docs, row_numbers = [], []
+        for row_number, row in batch:
+            try:
+                docs.append(build_import_doc(clean_import_row(row), dns_by_key))
+                row_numbers.append(row_number)
+            except ValidationError as e:
+                add_error(row_number, "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()))
+            except ValueError as e:
+                add_error(row_number, str(e))
+        if not docs:
+            continue
+        
+        try:
+            result = await db.users.insert_many(docs, ordered=False)
+            inserted += len(result.inserted_ids)
+        except BulkWriteError as e:
+            write_errors = e.details['writeErrors']
+            inserted += len(docs) - len(write_errors)
+            for err in write_errors:
+                message = "Username already exists" if err['code'] == 11000 else err['errmsg']
+                add_error(row_numbers[err['index']], message)
+    
+    if inserted:
+        start_background(rebuild_stats_snapshot())
+    return {"inserted": inserted, "failed": failed, "errors": errors, "errors_truncated": failed > len(errors),
+            "parse_error": parse_error}
 
 # ==================== DNS ROUTES ====================
 
 @api_router.get("/dns", response_model=List[DNS])
 async def get_dns_servers(current_admin: Admin = Depends(get_current_admin)):
-    servers = await db.dns_servers.find({}, {"_id": 0}).to_list(1000)
-    for server in servers:
-        if isinstance(server.get('created_at'), str):
-            server['created_at'] = datetime.fromisoformat(server['created_at'])
-    return servers
+    servers = await db.dns_servers.find({}, DNS_PROJECTION).to_list(1000)
+    reference.replace_dns([dict(server) for server in servers])
+    return fast_list_response(servers, DNS_DEFAULTS)
+
+@api_router.get("/dns/health")
+async def get_dns_health(hours: int = Query(24, ge=1, le=24 * 30), current_admin: Admin = Depends(get_current_admin)):
+    servers, buckets = await asyncio.gather(
+        db.dns_servers.find({}, {"_id": 0, "id": 1, "title": 1, "url": 1, "active": 1, "health": 1}).to_list(1000),
+        load_dns_buckets(hours),
+    )
+    by_dns = {}
+    for bucket in buckets:
+        by_dns.setdefault(bucket['dns_id'], []).append(bucket)
+    return [
+        {**server, "health": server.get('health'), **summarize_dns_buckets(by_dns.get(server['id'], []))}
+        for server in servers
+    ]
+
+@api_router.get("/dns/{dns_id}/health")
+async def get_dns_server_health(dns_id: str, hours: int = Query(24, ge=1, le=24 * 30), current_admin: Admin = Depends(get_current_admin)):
+    server = await db.dns_servers.find_one({"id": dns_id}, {"_id": 0, "id": 1, "title": 1, "url": 1, "active": 1, "health": 1})
+    if not server:
+        raise HTTPException(status_code=404, detail="DNS not found")
+    buckets = await load_dns_buckets(hours, dns_id)
+    return {
+        **server,
+        "health": server.get('health'),
+        **summarize_dns_buckets(buckets),
+        "history": [{"hour": b['hour'], **summarize_dns_buckets([b])} for b in buckets],
+    }
 
 @api_router.post("/dns", response_model=DNS)
 async def create_dns(dns_data: DNSCreate, current_admin: Admin = Depends(get_current_admin)):
@@ -364,13 +1324,47 @@ async def create_dns(dns_data: DNSCreate, current_admin: Admin = Depends(get_cur
     )
     
     doc = dns.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     await db.dns_servers.insert_one(doc)
+    doc.pop('_id', None)
+    reference.dns[doc['id']] = doc
+    await reference.changed()
+    await apply_stats_delta(total_dns=1)
     
     return dns
 
+DNS_PROPAGATION_BATCH_SIZE = int(os.environ.get('DNS_PROPAGATION_BATCH_SIZE', '1000'))
+
+async def run_dns_propagation_job(job_id: str, dns_id: str, dns_url: str):
+    # Rewrites lista_m3u in keyset batches of users, each one a single update_many
+    cursor = None
+    try:
+        while True:
+            current = await db.dns_servers.find_one({"id": dns_id}, {"_id": 0, "url": 1})
+            if not current or current['url'] != dns_url:
+                # A newer URL change started its own job; stop before writing stale links
+                await finish_job(job_id, error="Superseded by a newer DNS change")
+                return
+            query = {"dns_id": dns_id, **keyset_filter('created_at', cursor, False)}
+            batch = await db.users.find(query, {"_id": 0, "id": 1, "created_at": 1}) \
+                .sort([("created_at", ASCENDING), ("id", ASCENDING)]) \
+                .limit(DNS_PROPAGATION_BATCH_SIZE) \
+                .to_list(DNS_PROPAGATION_BATCH_SIZE)
+            if not batch:
+                break
+            await db.users.update_many(
+                {"id": {"$in": [user['id'] for user in batch]}, "dns_id": dns_id},
+                [{"$set": {"lista_m3u": lista_m3u_expression(dns_url)}}],
+            )
+            await update_job(job_id, inc={"processed": len(batch)})
+            cursor = encode_cursor([batch[-1]['created_at'], batch[-1]['id']])
+        invalidate_portal(dns_id=dns_id)
+        await finish_job(job_id)
+    except Exception as e:
+        logger.exception("DNS propagation job %s failed", job_id)
+        await finish_job(job_id, error=str(e))
+
 @api_router.put("/dns/{dns_id}", response_model=DNS)
-async def update_dns(dns_id: str, dns_data: DNSUpdate, current_admin: Admin = Depends(get_current_admin)):
+async def update_dns(dns_id: str, dns_data: DNSUpdate, response: Response, current_admin: Admin = Depends(get_current_admin)):
     existing = await db.dns_servers.find_one({"id": dns_id}, {"_id": 0})
     if not existing:
         raise HTTPException(status_code=404, detail="DNS not found")
@@ -379,8 +1373,16 @@ async def update_dns(dns_id: str, dns_data: DNSUpdate, current_admin: Admin = De
     await db.dns_servers.update_one({"id": dns_id}, {"$set": update_data})
     
     updated_dns = await db.dns_servers.find_one({"id": dns_id}, {"_id": 0})
-    if isinstance(updated_dns.get('created_at'), str):
-        updated_dns['created_at'] = datetime.fromisoformat(updated_dns['created_at'])
+    reference.dns[dns_id] = dict(updated_dns)
+    await reference.changed()
+    invalidate_portal(dns_id=dns_id)
+    
+    # Users embed the DNS URL in lista_m3u; rewrite them in the background
+    if updated_dns['url'] != existing['url']:
+        total = await db.users.count_documents({"dns_id": dns_id})
+        job = await create_job("dns_propagation", {"dns_id": dns_id, "url": updated_dns['url']}, total=total)
+        start_background(run_dns_propagation_job(job['id'], dns_id, updated_dns['url']))
+        response.headers["X-Job-Id"] = job['id']
     
     return DNS(**updated_dns)
 
@@ -389,17 +1391,45 @@ async def delete_dns(dns_id: str, current_admin: Admin = Depends(get_current_adm
     result = await db.dns_servers.delete_one({"id": dns_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="DNS not found")
+    reference.dns.pop(dns_id, None)
+    await reference.changed()
+    await apply_stats_delta(total_dns=-1)
+    invalidate_portal(dns_id=dns_id)
     return {"message": "DNS deleted successfully"}
 
 # ==================== PAYMENT ROUTES ====================
 
 @api_router.get("/payments", response_model=List[Payment])
 async def get_payments(current_admin: Admin = Depends(get_current_admin)):
-    payments = await db.payments.find({}, {"_id": 0}).to_list(1000)
-    for payment in payments:
-        if isinstance(payment.get('date'), str):
-            payment['date'] = datetime.fromisoformat(payment['date'])
-    return payments
+    payments = await db.payments.find({}, PAYMENT_PROJECTION).to_list(1000)
+    return fast_list_response(payments, PAYMENT_DEFAULTS)
+
+@api_router.get("/payments/page", response_model=PaymentPage)
+async def get_payments_page(
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    user_id: Optional[str] = None,
+    status_filter: Optional[str] = Query(None, alias="status"),
+    method: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    order: str = Query("desc", pattern="^(asc|desc)$"),
+    fields: Optional[str] = Query(None, description="Comma separated Payment fields to return"),
+    current_admin: Admin = Depends(get_current_admin)
+):
+    query = {}
+    if user_id is not None:
+        query['user_id'] = user_id
+    if status_filter is not None:
+        query['status'] = status_filter
+    if method is not None:
+        query['method'] = method
+    query.update(date_range_filter('date', date_from, date_to))
+
+    projection = parse_fields(fields, Payment, required=['id', 'date'])
+    payments, next_cursor = await fetch_page(db.payments, query, projection, 'date', limit, cursor, order == "desc")
+
+    return FastJSONResponse({"items": payments, "next_cursor": next_cursor})
 
 @api_router.post("/payments", response_model=Payment)
 async def create_payment(payment_data: PaymentCreate, current_admin: Admin = Depends(get_current_admin)):
@@ -417,32 +1447,151 @@ async def create_payment(payment_data: PaymentCreate, current_admin: Admin = Dep
     )
     
     doc = payment.model_dump()
-    doc['date'] = doc['date'].isoformat()
+    # Kept on the document so revenue rollups group by the panel at payment time
+    doc['dns_id'] = user['dns_id']
     await db.payments.insert_one(doc)
+    doc.pop('_id', None)
+    await apply_payment_stats(doc, 1)
+    await apply_revenue_rollup(doc, 1)
+    invalidate_portal(username=user['username'])
     
     return payment
 
 @api_router.delete("/payments/{payment_id}")
 async def delete_payment(payment_id: str, current_admin: Admin = Depends(get_current_admin)):
-    result = await db.payments.delete_one({"id": payment_id})
-    if result.deleted_count == 0:
+    deleted = await db.payments.find_one_and_delete({"id": payment_id}, {"_id": 0})
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Payment not found")
+    await apply_payment_stats(deleted, -1)
+    await apply_revenue_rollup(deleted, -1)
+    invalidate_portal(user_id=deleted['user_id'])
     return {"message": "Payment deleted successfully"}
 
+# ==================== EXPORT ====================
+
+EXPORT_BATCH_SIZE = 1000
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+def csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
+    if isinstance(value, (dict, list)):
+        return orjson.dumps(value, option=orjson.OPT_UTC_Z).decode()
+    return value
+
+async def export_chunks(cursor, fields: List[str], defaults: dict, export_format: str):
+    # Rows are encoded as they come off the cursor and flushed in ~64KB chunks,
+    # so memory stays flat whatever the size of the collection
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if export_format == "csv":
+        writer.writerow(fields)
+    pending = bytearray()
+    async for doc in cursor:
+        row = {**defaults, **doc}
+        if export_format == "csv":
+            writer.writerow([csv_value(row.get(field)) for field in fields])
+            pending += buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        else:
+            pending += orjson.dumps(row, option=orjson.OPT_UTC_Z | orjson.OPT_APPEND_NEWLINE)
+        if len(pending) >= EXPORT_CHUNK_BYTES:
+            yield bytes(pending)
+            pending.clear()
+    if export_format == "csv":
+        pending += buffer.getvalue().encode()
+    if pending:
+        yield bytes(pending)
+
+async def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export_response(cursor, model, defaults: dict, name: str, export_format: str, compress: bool) -> StreamingResponse:
+    chunks = export_chunks(cursor, list(model.model_fields), defaults, export_format)
+    media_type = "text/csv; charset=utf-8" if export_format == "csv" else "application/x-ndjson"
+    filename = f"{name}-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.{export_format}"
+    if compress:
+        chunks, media_type, filename = gzip_chunks(chunks), "application/gzip", filename + ".gz"
+    return StreamingResponse(chunks, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@api_router.get("/users/export")
+async def export_users(
+    export_format: str = Query("csv", alias="format", pattern="^(csv|ndjson)$"),
+    gzip: bool = False,
+    dns_id: Optional[str] = None,
+    status_filter: Optional[str] = Query(None, alias="status", pattern="^(active|inactive|expired|valid)$"),
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    expires_from: Optional[datetime] = None,
+    expires_to: Optional[datetime] = None,
+    current_admin: Admin = Depends(get_current_admin)
+):
+    query = {}
+    if dns_id is not None:
+        query['dns_id'] = dns_id
+    now = datetime.now(timezone.utc)
+    if status_filter in ("active", "inactive"):
+        query['active'] = status_filter == "active"
+    elif status_filter == "expired":
+        query['expires_at'] = {'$lt': now}
+    elif status_filter == "valid":
+        query['expires_at'] = {'$gte': now}
+    query.update(date_range_filter('created_at', created_from, created_to))
+    expires_range = date_range_filter('expires_at', expires_from, expires_to)
+    if expires_range:
+        # Kept apart so it does not overwrite the expired/valid bound
+        query['$and'] = [expires_range]
+    
+    cursor = db.users.find(query, USER_PROJECTION, batch_size=EXPORT_BATCH_SIZE) \
+        .sort([("created_at", ASCENDING), ("id", ASCENDING)])
+    return export_response(cursor, User, USER_DEFAULTS, "users", export_format, gzip)
+
+@api_router.get("/payments/export")
+async def export_payments(
+    export_format: str = Query("csv", alias="format", pattern="^(csv|ndjson)$"),
+    gzip: bool = False,
+    user_id: Optional[str] = None,
+    status_filter: Optional[str] = Query(None, alias="status"),
+    method: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    current_admin: Admin = Depends(get_current_admin)
+):
+    query = {}
+    if user_id is not None:
+        query['user_id'] = user_id
+    if status_filter is not None:
+        query['status'] = status_filter
+    if method is not None:
+        query['method'] = method
+    query.update(date_range_filter('date', date_from, date_to))
+    
+    cursor = db.payments.find(query, PAYMENT_PROJECTION, batch_size=EXPORT_BATCH_SIZE) \
+        .sort([("date", ASCENDING), ("id", ASCENDING)])
+    return export_response(cursor, Payment, PAYMENT_DEFAULTS, "payments", export_format, gzip)
+
 # ==================== SETTINGS ROUTES ====================
 
 @api_router.get("/settings", response_model=Settings)
 async def get_settings(current_admin: Admin = Depends(get_current_admin)):
-    settings = await db.settings.find_one({"id": "system_settings"}, {"_id": 0})
+    settings = await reference.get_settings()
     if not settings:
         default_settings = Settings()
         doc = default_settings.model_dump()
-        doc['updated_at'] = doc['updated_at'].isoformat()
         await db.settings.insert_one(doc)
+        doc.pop('_id', None)
+        reference.settings = doc
+        await reference.changed()
         return default_settings
-    
-    if isinstance(settings.get('updated_at'), str):
-        settings['updated_at'] = datetime.fromisoformat(settings['updated_at'])
+    settings = dict(settings)
     
     # Garantir campos novos
     if 'whatsapp_enabled' not in settings:
@@ -460,127 +1609,698 @@ async def get_settings(current_admin: Admin = Depends(get_current_admin)):
 
 @api_router.get("/templates")
 async def get_templates(current_admin: Admin = Depends(get_current_admin)):
-    templates = await db.templates.find({}, {"_id": 0}).to_list(100)
-    return templates
+    return list(reference.templates.values())
 
 @api_router.post("/templates")
 async def create_template(name: str, message: str, current_admin: Admin = Depends(get_current_admin)):
     template = MessageTemplate(name=name, message=message)
     doc = template.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     await db.templates.insert_one(doc)
+    doc.pop('_id', None)
+    reference.templates[doc['id']] = doc
+    await reference.changed()
     return template
 
 @api_router.put("/templates/{template_id}")
 async def update_template(template_id: str, name: str, message: str, current_admin: Admin = Depends(get_current_admin)):
     await db.templates.update_one({"id": template_id}, {"$set": {"name": name, "message": message}})
     template = await db.templates.find_one({"id": template_id}, {"_id": 0})
+    if template:
+        reference.templates[template_id] = template
+        await reference.changed()
     return template
 
 @api_router.delete("/templates/{template_id}")
 async def delete_template(template_id: str, current_admin: Admin = Depends(get_current_admin)):
     await db.templates.delete_one({"id": template_id})
+    reference.templates.pop(template_id, None)
+    await reference.changed()
     return {"message": "Template deleted"}
 
 @api_router.get("/whatsapp/qrcode")
 async def get_qrcode(current_admin: Admin = Depends(get_current_admin)):
-    settings = await db.settings.find_one({"id": "system_settings"}, {"_id": 0})
+    settings = await reference.get_settings()
     if not settings or not settings.get('whatsapp_instance'):
         raise HTTPException(status_code=400, detail="WhatsApp not configured")
     
     url = f"{settings['whatsapp_url']}/{settings['whatsapp_instance']}/qrcode"
     headers = {"Token": settings['whatsapp_token']}
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers, timeout=10.0)
-        return response.json()
+    response = await http_clients.wuzapi.get(url, headers=headers)
+    return response.json()
 
 @api_router.put("/settings", response_model=Settings)
 async def update_settings(settings_data: SettingsUpdate, current_admin: Admin = Depends(get_current_admin)):
     update_data = {k: v for k, v in settings_data.model_dump().items() if v is not None}
-    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
+    update_data['updated_at'] = datetime.now(timezone.utc)
     
     await db.settings.update_one(
         {"id": "system_settings"},
         {"$set": update_data},
         upsert=True
     )
+    portal_cache.clear()
     
     updated_settings = await db.settings.find_one({"id": "system_settings"}, {"_id": 0})
-    if isinstance(updated_settings.get('updated_at'), str):
-        updated_settings['updated_at'] = datetime.fromisoformat(updated_settings['updated_at'])
+    reference.settings = dict(updated_settings)
+    await reference.changed()
     
     return Settings(**updated_settings)
 
+# ==================== STATS SNAPSHOT ====================
+
+# Dashboard stats are served from a snapshot document shared by every worker.
+# Writes apply $inc deltas to it and a background refresher rebuilds it
+# periodically, which also picks up users expiring over time.
+STATS_REFRESH_SECONDS = float(os.environ.get('STATS_REFRESH_SECONDS', '300'))
+RECENT_PAYMENTS_LIMIT = 5
+STATS_SNAPSHOT_ID = "dashboard"
+
+def _is_expired(expires_at, now: datetime) -> bool:
+    return isinstance(expires_at, datetime) and expires_at < now
+
+async def rebuild_stats_snapshot() -> dict:
+    now = datetime.now(timezone.utc)
+    # One round trip: users, dns_servers and payments are unioned and counted in a single $facet
+    pipeline = [
+        {"$project": {
+            "_id": 0,
+            "src": {"$literal": "users"},
+            "active": 1,
+            "expires_at": 1,
+        }},
+        {"$unionWith": {"coll": "dns_servers", "pipeline": [
+            {"$project": {"_id": 0, "src": {"$literal": "dns"}}},
+        ]}},
+        {"$unionWith": {"coll": "payments", "pipeline": [
+            {"$project": {"_id": 0, "src": {"$literal": "payments"}, "id": 1, "user_id": 1, "amount": 1,
+                          "date": 1, "status": 1, "method": 1, "notes": 1}},
+        ]}},
+        {"$facet": {
+            "users": [
+                {"$match": {"src": "users"}},
+                {"$group": {
+                    "_id": None,
+                    "total": {"$sum": 1},
+                    "active": {"$sum": {"$cond": [{"$eq": ["$active", True]}, 1, 0]}},
+                    "expired": {"$sum": {"$cond": [
+                        {"$and": [
+                            {"$eq": [{"$type": "$expires_at"}, "date"]},
+                            {"$lt": ["$expires_at", now]},
+                        ]}, 1, 0]}},
+                }},
+            ],
+            "dns": [{"$match": {"src": "dns"}}, {"$count": "total"}],
+            "revenue": [
+                {"$match": {"src": "payments", "status": "completed"}},
+                {"$group": {"_id": None, "total": {"$sum": "$amount"}}},
+            ],
+            "recent_payments": [
+                {"$match": {"src": "payments"}},
+                {"$sort": {"date": -1}},
+                {"$limit": RECENT_PAYMENTS_LIMIT},
+                {"$project": {"src": 0}},
+            ],
+        }},
+    ]
+    result = (await db.users.aggregate(pipeline).to_list(1))[0]
+    users = result['users'][0] if result['users'] else {}
+    recent_payments = result['recent_payments']
+
+    snapshot = {
+        "total_users": users.get('total', 0),
+        "active_users": users.get('active', 0),
+        "expired_users": users.get('expired', 0),
+        "total_dns": result['dns'][0]['total'] if result['dns'] else 0,
+        "total_revenue": result['revenue'][0]['total'] if result['revenue'] else 0.0,
+        "recent_payments": recent_payments,
+        "generated_at": now,
+    }
+    await db.stats_snapshot.replace_one({"_id": STATS_SNAPSHOT_ID}, snapshot, upsert=True)
+    return snapshot
+
+async def get_stats_snapshot() -> Optional[dict]:
+    return await db.stats_snapshot.find_one({"_id": STATS_SNAPSHOT_ID}, {"_id": 0})
+
+async def apply_stats_delta(**deltas):
+    # No upsert: until the first rebuild there is nothing to adjust
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if deltas:
+        await db.stats_snapshot.update_one({"_id": STATS_SNAPSHOT_ID}, {"$inc": deltas})
+
+def user_stats_delta(before: Optional[dict], after: Optional[dict]) -> dict:
+    now = datetime.now(timezone.utc)
+
+    def counters(user):
+        if user is None:
+            return 0, 0, 0
+        return 1, int(user.get('active', True)), int(_is_expired(user.get('expires_at'), now))
+
+    old, new = counters(before), counters(after)
+    return {
+        "total_users": new[0] - old[0],
+        "active_users": new[1] - old[1],
+        "expired_users": new[2] - old[2],
+    }
+
+async def apply_user_stats(before: Optional[dict], after: Optional[dict]):
+    await apply_stats_delta(**user_stats_delta(before, after))
+
+async def apply_payment_stats(payment: dict, sign: int):
+    if payment.get('status') == 'completed':
+        await apply_stats_delta(total_revenue=sign * payment['amount'])
+    if sign > 0:
+        await db.stats_snapshot.update_one({"_id": STATS_SNAPSHOT_ID}, {"$push": {"recent_payments": {
+            "$each": [payment], "$sort": {"date": -1}, "$slice": RECENT_PAYMENTS_LIMIT,
+        }}})
+    else:
+        removed = await db.stats_snapshot.update_one(
+            {"_id": STATS_SNAPSHOT_ID}, {"$pull": {"recent_payments": {"id": payment['id']}}}
+        )
+        if removed.modified_count:
+            # A recent payment was removed; refill the list from the database
+            start_background(rebuild_stats_snapshot())
+
+async def stats_refresher():
+    while True:
+        try:
+            # Every worker runs this loop; the lease keeps it to one rebuild per period
+            if await acquire_lease("stats_snapshot", STATS_REFRESH_SECONDS * 0.9):
+                await rebuild_stats_snapshot()
+        except Exception as e:
+            logger.error("Stats snapshot refresh failed: %s", e)
+        await asyncio.sleep(STATS_REFRESH_SECONDS)
+
+# ==================== REVENUE ROLLUPS ====================
+
+# Completed payments are summed into daily buckets per method and DNS, with days
+# cut in the business timezone, so reports never scan the payments collection
+REPORT_TIMEZONE = ZoneInfo(os.environ.get('REPORT_TIMEZONE', BUSINESS_TIMEZONE.key))
+
+def local_day_start(day: dt_date) -> datetime:
+    return datetime.combine(day, dt_time.min, tzinfo=REPORT_TIMEZONE).astimezone(timezone.utc)
+
+async def apply_revenue_rollup(payment: dict, sign: int):
+    if payment.get('status') != "completed":
+        return
+    if 'dns_id' in payment:
+        dns_id = payment['dns_id']
+    else:
+        # Payments recorded before rollups existed fall back to the user's current DNS
+        user = await db.users.find_one({"id": payment['user_id']}, {"_id": 0, "dns_id": 1})
+        dns_id = user['dns_id'] if user else None
+    paid_at = read_stored_datetime(payment.get('date'))
+    if paid_at is None:
+        logger.warning("Payment %s has no usable date, revenue rollup left as is", payment.get('id'))
+        return
+    await db.revenue_daily.update_one(
+        {
+            "day": local_day_start(paid_at.astimezone(REPORT_TIMEZONE).date()),
+            "method": payment.get('method'),
+            "dns_id": dns_id,
+        },
+        {"$inc": {"amount": sign * payment['amount'], "count": sign}},
+        upsert=True,
+    )
+
+async def rebuild_revenue_rollups():
+    # $out swaps the rebuilt collection in atomically and keeps its indexes
+    await db.payments.aggregate([
+        {"$match": {"status": "completed", "date": {"$type": "date"}}},
+        {"$lookup": {"from": "users", "localField": "user_id", "foreignField": "id",
+                     "pipeline": [{"$project": {"_id": 0, "dns_id": 1}}], "as": "user"}},
+        {"$group": {
+            "_id": {
+                "day": {"$dateTrunc": {"date": "$date", "unit": "day", "timezone": REPORT_TIMEZONE.key}},
+                "method": "$method",
+                "dns_id": {"$ifNull": ["$dns_id", {"$first": "$user.dns_id"}]},
+            },
+            "amount": {"$sum": "$amount"},
+            "count": {"$sum": 1},
+        }},
+        {"$project": {"_id": 0, "day": "$_id.day", "method": "$_id.method", "dns_id": "$_id.dns_id",
+                      "amount": 1, "count": 1}},
+        {"$out": "revenue_daily"},
+    ]).to_list(None)
+
+async def run_revenue_rollup_job(job_id: str):
+    try:
+        await rebuild_revenue_rollups()
+        await db.migrations.update_one(
+            {"_id": "revenue_rollups"}, {"$set": {"done_at": datetime.now(timezone.utc)}}, upsert=True
+        )
+        await finish_job(job_id)
+    except Exception as e:
+        logger.exception("Revenue rollup job %s failed", job_id)
+        await finish_job(job_id, error=str(e))
+
+async def ensure_revenue_rollups():
+    # First start after upgrading: build the buckets from the existing payments
+    if await db.migrations.find_one({"_id": "revenue_rollups"}):
+        return
+    if not await db.migrations.find_one({"_id": "native_dates"}):
+        return
+    if not await acquire_lease("revenue_rollups", 3600):
+        return
+    job = await create_job("revenue_rollup", {"reason": "initial"})
+    await run_revenue_rollup_job(job['id'])
+
 # ==================== STATS ROUTES ====================
 
 @api_router.get("/stats", response_model=Stats)
-async def get_stats(current_admin: Admin = Depends(get_current_admin)):
-    total_users = await db.users.count_documents({})
-    active_users = await db.users.count_documents({"active": True})
+async def get_stats(refresh: bool = False, current_admin: Admin = Depends(get_current_admin)):
+    snapshot = None if refresh else await get_stats_snapshot()
+    if snapshot is None:
+        snapshot = await rebuild_stats_snapshot()
     
-    # Count expired users
-    now = datetime.now(timezone.utc).isoformat()
-    expired_users = await db.users.count_documents({"expires_at": {"$lt": now}})
+    return Stats(
+        total_users=snapshot['total_users'],
+        active_users=snapshot['active_users'],
+        expired_users=snapshot['expired_users'],
+        total_dns=snapshot['total_dns'],
+        total_revenue=snapshot['total_revenue'],
+        recent_payments=[Payment(**p) for p in snapshot['recent_payments']],
+        generated_at=snapshot['generated_at'],
+        age_seconds=(datetime.now(timezone.utc) - snapshot['generated_at']).total_seconds()
+    )
+
+# ==================== REPORT ROUTES ====================
+
+REPORT_PERIOD_FORMATS = {"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}
+REPORT_GROUPS = {*REPORT_PERIOD_FORMATS, "method", "dns_id"}
+
+@api_router.get("/reports/revenue")
+async def get_revenue_report(
+    date_from: Optional[dt_date] = None,
+    date_to: Optional[dt_date] = Query(None, description="Inclusive"),
+    group_by: str = Query("day", description="Comma separated: day, month or year, method, dns_id"),
+    method: Optional[str] = None,
+    dns_id: Optional[str] = None,
+    current_admin: Admin = Depends(get_current_admin)
+):
+    groups = [g.strip() for g in group_by.split(",") if g.strip()]
+    if not groups or not set(groups) <= REPORT_GROUPS or len(set(groups) & set(REPORT_PERIOD_FORMATS)) > 1:
+        raise HTTPException(status_code=400, detail="group_by takes at most one of day, month, year plus method and dns_id")
     
-    total_dns = await db.dns_servers.count_documents({})
+    query = {}
+    if date_from is not None or date_to is not None:
+        query['day'] = {}
+        if date_from is not None:
+            query['day']['$gte'] = local_day_start(date_from)
+        if date_to is not None:
+            query['day']['$lt'] = local_day_start(date_to + timedelta(days=1))
+    if method is not None:
+        query['method'] = method
+    if dns_id is not None:
+        query['dns_id'] = dns_id
     
-    # Calculate total revenue
-    pipeline = [
-        {"$match": {"status": "completed"}},
-        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-    ]
-    revenue_result = await db.payments.aggregate(pipeline).to_list(1)
-    total_revenue = revenue_result[0]['total'] if revenue_result else 0.0
+    key = {}
+    for group in groups:
+        if group in REPORT_PERIOD_FORMATS:
+            key['period'] = {"$dateToString": {"date": "$day", "format": REPORT_PERIOD_FORMATS[group],
+                                               "timezone": REPORT_TIMEZONE.key}}
+        else:
+            key[group] = f"${group}"
     
-    # Get recent payments
-    recent_payments = await db.payments.find({}, {"_id": 0}).sort("date", -1).limit(5).to_list(5)
-    for payment in recent_payments:
-        if isinstance(payment.get('date'), str):
-            payment['date'] = datetime.fromisoformat(payment['date'])
+    rows = await db.revenue_daily.aggregate([
+        {"$match": query},
+        {"$group": {"_id": key, "amount": {"$sum": "$amount"}, "count": {"$sum": "$count"}}},
+        {"$match": {"count": {"$gt": 0}}},
+        {"$sort": {f"_id.{field}": 1 for field in key}},
+    ]).to_list(None)
     
-    return Stats(
-        total_users=total_users,
-        active_users=active_users,
-        expired_users=expired_users,
-        total_dns=total_dns,
-        total_revenue=total_revenue,
-        recent_payments=[Payment(**p) for p in recent_payments]
-    )
+    items = []
+    for row in rows:
+        item = {**row['_id'], "amount": round(row['amount'], 2), "count": row['count']}
+        if 'dns_id' in item:
+            item['dns_title'] = (reference.dns.get(item['dns_id']) or {}).get('title')
+        items.append(item)
+    return FastJSONResponse({
+        "items": items,
+        "total": {
+            "amount": round(sum((row['amount'] for row in rows), 0.0), 2),
+            "count": sum(row['count'] for row in rows),
+        },
+    })
+
+@api_router.post("/reports/revenue/rebuild", status_code=202)
+async def rebuild_revenue_report(current_admin: Admin = Depends(get_current_admin)):
+    job = await create_job("revenue_rollup", {"reason": "manual"})
+    start_background(run_revenue_rollup_job(job['id']))
+    return job
+
+# ==================== SYSTEM ROUTES ====================
+
+@api_router.get("/system/cache")
+async def get_cache_stats(current_admin: Admin = Depends(get_current_admin)):
+    return cache_stats()
+
+@api_router.get("/system/auth")
+async def get_auth_stats(current_admin: Admin = Depends(get_current_admin)):
+    return {
+        "password_pool": {
+            "workers": PASSWORD_HASH_WORKERS,
+            "queue": PASSWORD_HASH_QUEUE,
+            "pending": password_pending,
+        },
+        "login_throttle": {
+            "email": login_email_throttle.stats(),
+            "ip": login_ip_throttle.stats(),
+        },
+    }
+
+@api_router.get("/system/queries")
+async def get_query_stats(
+    limit: int = Query(20, ge=1, le=500),
+    sort: str = Query("total_ms", pattern="^(total_ms|max_ms|avg_ms|count|slow)$"),
+    current_admin: Admin = Depends(get_current_admin)
+):
+    return query_monitor.report(limit, sort)
+
+@api_router.delete("/system/queries")
+async def reset_query_stats(current_admin: Admin = Depends(get_current_admin)):
+    query_monitor.reset()
+    return {"message": "Query statistics reset"}
+
+@api_router.get("/system/http")
+async def get_http_stats(current_admin: Admin = Depends(get_current_admin)):
+    return http_clients.stats()
+
+# ==================== JOB ROUTES ====================
+
+@api_router.get("/jobs")
+async def get_jobs(
+    job_type: Optional[str] = Query(None, alias="type"),
+    limit: int = Query(20, ge=1, le=100),
+    current_admin: Admin = Depends(get_current_admin)
+):
+    query = {"type": job_type} if job_type else {}
+    return await db.jobs.find(query, {"_id": 0}).sort("started_at", -1).limit(limit).to_list(limit)
+
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str, current_admin: Admin = Depends(get_current_admin)):
+    job = await db.jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 # ==================== PUBLIC USER PORTAL ====================
 
-@api_router.get("/portal/{username}")
-async def get_user_portal(username: str):
+PORTAL_PAYMENTS_LIMIT = int(os.environ.get('PORTAL_PAYMENTS_LIMIT', '20'))
+
+def invalidate_portal(username: Optional[str] = None, user_id: Optional[str] = None, dns_id: Optional[str] = None):
+    if username is not None:
+        portal_cache.invalidate(username)
+    if user_id is not None:
+        portal_cache.invalidate_where(lambda key, entry: entry['user_id'] == user_id)
+    if dns_id is not None:
+        portal_cache.invalidate_where(lambda key, entry: entry['dns_id'] == dns_id)
+
+async def build_portal_entry(username: str) -> Optional[dict]:
     user = await db.users.find_one({"username": username}, {"_id": 0})
     if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    # Get DNS info
-    dns = await db.dns_servers.find_one({"id": user['dns_id']}, {"_id": 0})
+        return None
     
-    # Get user payments
-    payments = await db.payments.find({"user_id": user['id']}, {"_id": 0}).sort("date", -1).to_list(100)
-    for payment in payments:
-        if isinstance(payment.get('date'), str):
-            payment['date'] = datetime.fromisoformat(payment['date'])
-    
-    # Get settings
-    settings = await db.settings.find_one({"id": "system_settings"}, {"_id": 0})
-    
-    if isinstance(user.get('created_at'), str):
-        user['created_at'] = datetime.fromisoformat(user['created_at'])
-    if 'expire_date' in user and 'expires_at' not in user:
-        user['expires_at'] = user['expire_date']
-    if isinstance(user.get('expires_at'), str):
-        user['expires_at'] = datetime.fromisoformat(user['expires_at'])
+    # DNS and settings are usually served from memory; whatever misses is fetched concurrently
+    dns, (payments, payments_cursor), settings = await asyncio.gather(
+        reference.get_dns(user['dns_id']),
+        fetch_page(db.payments, {"user_id": user['id']}, PAYMENT_PROJECTION, 'date', PORTAL_PAYMENTS_LIMIT, None, True),
+        reference.get_settings(),
+    )
     
-    return {
+    payload = {
         "user": User(**user),
         "dns": DNS(**dns) if dns else None,
         "payments": [Payment(**p) for p in payments],
+        # Older payments are paged through /portal/{username}/payments
+        "payments_next_cursor": payments_cursor,
         "whatsapp_support": settings.get('whatsapp_support', '') if settings else ''
     }
+    body = json.dumps(jsonable_encoder(payload), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return {
+        "body": body,
+        "etag": '"' + hashlib.sha1(body).hexdigest() + '"',
+        "user_id": user['id'],
+        "dns_id": user['dns_id'],
+    }
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+@api_router.get("/portal/{username}")
+async def get_user_portal(username: str, if_none_match: Optional[str] = Header(None)):
+    entry = portal_cache.get(username)
+    if entry is None:
+        entry = await build_portal_entry(username)
+        if entry is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        portal_cache.set(username, entry)
+    
+    # Browsers revalidate on every visit and get an empty 304 while nothing changed
+    headers = {"ETag": entry['etag'], "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, entry['etag']):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry['body'], media_type="application/json", headers=headers)
+
+@api_router.get("/portal/{username}/payments", response_model=PaymentPage)
+async def get_user_portal_payments(
+    username: str,
+    limit: int = Query(PORTAL_PAYMENTS_LIMIT, ge=1, le=100),
+    cursor: Optional[str] = None
+):
+    entry = portal_cache.get(username)
+    if entry is not None:
+        user_id = entry['user_id']
+    else:
+        user = await db.users.find_one({"username": username}, {"_id": 0, "id": 1})
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        user_id = user['id']
+    
+    payments, next_cursor = await fetch_page(db.payments, {"user_id": user_id}, PAYMENT_PROJECTION, 'date', limit, cursor, True)
+    return FastJSONResponse({
+        "items": [{**PAYMENT_DEFAULTS, **payment} for payment in payments],
+        "next_cursor": next_cursor,
+    })
+
+# ==================== WHATSAPP OUTBOX ====================
+
+# Messages are persisted first and delivered by background dispatchers, so
+# admin requests never wait on WuzAPI and failed sends are retried, not lost.
+OUTBOX_CONCURRENCY = int(os.environ.get('OUTBOX_CONCURRENCY', '4'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_BACKOFF_SECONDS = float(os.environ.get('OUTBOX_BACKOFF_SECONDS', '10'))
+OUTBOX_MAX_BACKOFF_SECONDS = float(os.environ.get('OUTBOX_MAX_BACKOFF_SECONDS', '900'))
+OUTBOX_POLL_SECONDS = float(os.environ.get('OUTBOX_POLL_SECONDS', '5'))
+OUTBOX_RETENTION_DAYS = int(os.environ.get('OUTBOX_RETENTION_DAYS', '30'))
+OUTBOX_RATE_PER_SECOND = float(os.environ.get('OUTBOX_RATE_PER_SECOND', '1'))
+# A claimed message goes back to the queue if its dispatcher dies mid-send
+OUTBOX_CLAIM_SECONDS = float(os.environ.get('WUZAPI_TIMEOUT', '30')) + 30
+outbox_wakeup = asyncio.Event()
+outbox_next_send = 0.0
+
+async def outbox_throttle():
+    # Spaces sends from all dispatchers in this process by 1/OUTBOX_RATE_PER_SECOND
+    global outbox_next_send
+    now = time.monotonic()
+    slot = max(now, outbox_next_send)
+    outbox_next_send = slot + 1 / OUTBOX_RATE_PER_SECOND
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+def new_outbox_message(phone: str, message: str, user_id: Optional[str] = None,
+                       source: str = "manual", message_id: Optional[str] = None) -> dict:
+    now = datetime.now(timezone.utc)
+    return {
+        "id": message_id or str(uuid.uuid4()),
+        "user_id": user_id,
+        "phone": phone,
+        "message": message,
+        "source": source,
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "created_at": now,
+        "sent_at": None,
+        "last_error": None,
+        "http_status": None,
+        "latency_ms": None,
+    }
+
+async def claim_outbox_message() -> Optional[dict]:
+    now = datetime.now(timezone.utc)
+    return await db.outbox.find_one_and_update(
+        {"status": {"$in": ["pending", "sending"]}, "next_attempt_at": {"$lte": now}},
+        {"$set": {"status": "sending", "next_attempt_at": now + timedelta(seconds=OUTBOX_CLAIM_SECONDS)},
+         "$inc": {"attempts": 1}},
+        sort=[("next_attempt_at", ASCENDING)],
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER,
+    )
+
+async def deliver_outbox_message(message: dict):
+    started = time.perf_counter()
+    error, http_status, retryable = None, None, True
+    settings = await reference.get_settings()
+    if not settings or not settings.get('whatsapp_enabled'):
+        error = "WhatsApp not configured"
+    else:
+        try:
+            result = await send_whatsapp_message(message['phone'], message['message'], settings)
+            http_status = result['status']
+            if result['success']:
+                wuzapi_breaker.record_success()
+            elif http_status >= 500 or http_status == 429:
+                wuzapi_breaker.record_failure()
+                error = f"HTTP {http_status}"
+            else:
+                # WuzAPI answered but rejected the message; retrying will not help
+                wuzapi_breaker.record_success()
+                error, retryable = f"HTTP {http_status}", False
+        except Exception as e:
+            wuzapi_breaker.record_failure()
+            error = str(e) or type(e).__name__
+
+    now = datetime.now(timezone.utc)
+    update = {"http_status": http_status, "latency_ms": round((time.perf_counter() - started) * 1000, 1), "last_error": error}
+    if error is None:
+        update.update(status="sent", sent_at=now)
+    elif not retryable or message['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+        update['status'] = "failed"
+    else:
+        backoff = min(OUTBOX_BACKOFF_SECONDS * 2 ** (message['attempts'] - 1), OUTBOX_MAX_BACKOFF_SECONDS)
+        update.update(status="pending", next_attempt_at=now + timedelta(seconds=backoff))
+    await db.outbox.update_one({"id": message['id']}, {"$set": update})
+
+async def outbox_dispatcher():
+    while True:
+        try:
+            if not wuzapi_breaker.allow():
+                # WuzAPI is failing: leave messages queued until the breaker half-opens
+                await asyncio.sleep(max(wuzapi_breaker.retry_in(), 1.0))
+                continue
+            trial = wuzapi_breaker.state == "half_open"
+            outcomes = wuzapi_breaker.outcomes
+            try:
+                message = await claim_outbox_message()
+                if message is None:
+                    if trial:
+                        wuzapi_breaker.cancel_trial()
+                        trial = False
+                    outbox_wakeup.clear()
+                    try:
+                        await asyncio.wait_for(outbox_wakeup.wait(), timeout=OUTBOX_POLL_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await outbox_throttle()
+                await deliver_outbox_message(message)
+            finally:
+                # A trial that ended without reaching WuzAPI (not configured, a
+                # database error, cancellation) would keep the breaker half-open forever
+                if trial and wuzapi_breaker.outcomes == outcomes:
+                    wuzapi_breaker.cancel_trial()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Outbox dispatcher error: %s", e)
+            await asyncio.sleep(OUTBOX_POLL_SECONDS)
+
+# ==================== EXPIRATION REMINDERS ====================
+
+# Days before expiration on which subscribers get a reminder, e.g. "3,1,0"
+REMINDER_WINDOWS = [int(d) for d in os.environ.get('REMINDER_WINDOWS', '3,1,0').split(',') if d.strip()]
+REMINDER_INTERVAL_SECONDS = float(os.environ.get('REMINDER_INTERVAL_SECONDS', '3600'))
+REMINDER_BATCH_SIZE = int(os.environ.get('REMINDER_BATCH_SIZE', '500'))
+REMINDER_TIMEZONE = ZoneInfo(os.environ.get('REMINDER_TIMEZONE', BUSINESS_TIMEZONE.key))
+
+def render_reminder(user: dict) -> str:
+    expires_at = read_stored_datetime(user.get('expires_at'))
+    return format_expiring_message(
+        name=user.get('name') or user['username'],
+        username=user['username'],
+        expires_at=expires_at.astimezone(REMINDER_TIMEZONE).strftime('%d/%m/%Y') if expires_at else '',
+        plan_price=user.get('plan_price') or 0.0,
+        pay_url=user.get('pay_url') or '',
+        notes=""
+    )
+
+def reminder_key(days: int, today: dt_date) -> str:
+    return f"{days}d:{(today + timedelta(days=days)).isoformat()}"
+
+async def queue_reminders(users: List[dict], key: str, current_keys: List[str]) -> int:
+    # Outbox ids are derived from user and reminder key, so a repeated pass
+    # (or a crash between the two writes) can never queue the same reminder twice
+    messages = [
+        new_outbox_message(user['phone'], render_reminder(user), user_id=user['id'],
+                           source="reminder", message_id=f"reminder:{user['id']}:{key}")
+        for user in users
+    ]
+    queued = len(messages)
+    try:
+        await db.outbox.insert_many(messages, ordered=False)
+    except BulkWriteError as e:
+        duplicates = [err for err in e.details['writeErrors'] if err['code'] == 11000]
+        if len(duplicates) != len(e.details['writeErrors']):
+            raise
+        queued -= len(duplicates)
+    # Keys of windows that already passed are dropped, so the list stays as long
+    # as REMINDER_WINDOWS instead of growing with every renewal
+    user_ids = [user['id'] for user in users]
+    await db.users.bulk_write([
+        UpdateMany({"id": {"$in": user_ids}}, {"$pull": {"reminders_sent": {"$nin": current_keys}}}),
+        UpdateMany({"id": {"$in": user_ids}}, {"$addToSet": {"reminders_sent": key}}),
+    ])
+    return queued
+
+async def run_reminder_pass(job_id: str):
+    try:
+        settings = await reference.get_settings()
+        if not settings or not settings.get('whatsapp_enabled'):
+            await finish_job(job_id, error="WhatsApp not configured")
+            return
+        today = datetime.now(REMINDER_TIMEZONE).date()
+        projection = {"_id": 0, "id": 1, "username": 1, "name": 1, "phone": 1,
+                      "expires_at": 1, "plan_price": 1, "pay_url": 1}
+        current_keys = [reminder_key(days, today) for days in REMINDER_WINDOWS]
+        for days in REMINDER_WINDOWS:
+            day = today + timedelta(days=days)
+            start = datetime.combine(day, dt_time.min, tzinfo=REMINDER_TIMEZONE)
+            key = reminder_key(days, today)
+            query = {
+                "active": True,
+                "phone": {"$nin": [None, ""]},
+                "expires_at": {"$gte": start, "$lt": start + timedelta(days=1)},
+                "reminders_sent": {"$ne": key},
+            }
+            batch = []
+            async for user in db.users.find(query, projection).batch_size(REMINDER_BATCH_SIZE):
+                batch.append(user)
+                if len(batch) >= REMINDER_BATCH_SIZE:
+                    queued = await queue_reminders(batch, key, current_keys)
+                    await update_job(job_id, inc={"processed": len(batch), "queued": queued})
+                    batch = []
+            if batch:
+                queued = await queue_reminders(batch, key, current_keys)
+                await update_job(job_id, inc={"processed": len(batch), "queued": queued})
+        outbox_wakeup.set()
+        await finish_job(job_id)
+    except Exception as e:
+        logger.exception("Reminder pass %s failed", job_id)
+        await finish_job(job_id, error=str(e))
+
+async def reminder_scheduler():
+    while True:
+        try:
+            if await acquire_lease("reminder_scheduler", REMINDER_INTERVAL_SECONDS):
+                job = await create_job("reminders", {"windows": REMINDER_WINDOWS})
+                await run_reminder_pass(job['id'])
+        except Exception as e:
+            logger.error("Reminder scheduler failed: %s", e)
+        await asyncio.sleep(REMINDER_INTERVAL_SECONDS)
 
 # ==================== WHATSAPP NOTIFICATIONS ====================
 
@@ -589,9 +2309,9 @@ class SendWhatsAppRequest(BaseModel):
     phone: Optional[str] = None
     message: Optional[str] = None
 
-@api_router.post("/notifications/send-whatsapp")
+@api_router.post("/notifications/send-whatsapp", status_code=202)
 async def send_whatsapp_notification(request: SendWhatsAppRequest, current_admin: Admin = Depends(get_current_admin)):
-    settings = await db.settings.find_one({"id": "system_settings"}, {"_id": 0})
+    settings = await reference.get_settings()
     if not settings or not settings.get('whatsapp_enabled'):
         raise HTTPException(status_code=400, detail="WhatsApp not configured")
     
@@ -603,33 +2323,79 @@ async def send_whatsapp_notification(request: SendWhatsAppRequest, current_admin
     if not phone:
         raise HTTPException(status_code=400, detail="Phone required")
     
-    message = request.message
-    if not message:
-        if isinstance(user.get('expires_at'), str):
-            user['expires_at'] = datetime.fromisoformat(user['expires_at'])
-        expires_at_str = user['expires_at'].strftime('%d/%m/%Y') if user.get('expires_at') else ''
-        message = format_expiring_message(
-            name=user.get('name', user['username']),
-            username=user['username'],
-            expires_at=expires_at_str,
-            plan_price=user.get('plan_price', 0.0),
-            pay_url=user.get('pay_url', ''),
-            notes=""
-        )
+    message = request.message or render_reminder(user)
     
-    result = await send_whatsapp_message(phone, message, settings)
-    return {"success": result["success"]}
+    doc = new_outbox_message(phone, message, user_id=user['id'])
+    await db.outbox.insert_one(doc)
+    outbox_wakeup.set()
+    return {"success": True, "id": doc['id'], "status": doc['status']}
+
+@api_router.post("/notifications/reminders/run", status_code=202)
+async def run_reminders(current_admin: Admin = Depends(get_current_admin)):
+    job = await create_job("reminders", {"windows": REMINDER_WINDOWS})
+    start_background(run_reminder_pass(job['id']))
+    return job
+
+@api_router.get("/notifications/outbox")
+async def get_outbox(
+    status: Optional[str] = None,
+    user_id: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    current_admin: Admin = Depends(get_current_admin)
+):
+    query = {}
+    if status is not None:
+        query['status'] = status
+    if user_id is not None:
+        query['user_id'] = user_id
+    return await db.outbox.find(query, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+
+@api_router.get("/notifications/outbox/stats")
+async def get_outbox_stats(current_admin: Admin = Depends(get_current_admin)):
+    counts = await db.outbox.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]).to_list(None)
+    return {
+        "counts": {c['_id']: c['count'] for c in counts},
+        "circuit_breaker": wuzapi_breaker.stats(),
+    }
+
+@api_router.get("/notifications/outbox/{message_id}")
+async def get_outbox_message(message_id: str, current_admin: Admin = Depends(get_current_admin)):
+    message = await db.outbox.find_one({"id": message_id}, {"_id": 0})
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    return message
 
 
 # Include the router in the main app
 app.include_router(api_router)
 
+# ==================== METRICS ====================
+
+# Prometheus scrapes replicas directly over the internal network; the proxy does not
+# route /metrics, and METRICS_TOKEN guards it wherever it is reachable. Without a
+# token the endpoint stays closed
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics(authorization: Optional[str] = Header(None)):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=403, detail="Metrics are disabled, set METRICS_TOKEN")
+    if not secrets.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+app.add_middleware(PrometheusMiddleware)
+app.add_middleware(QueryMonitorMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    # The SPA reads the propagation job id from PUT /dns/{id} to follow its progress
+    expose_headers=["X-Job-Id"],
 )
 
 # Configure logging
@@ -639,6 +2405,204 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ==================== DATABASE INDEXES ====================
+
+INDEXES = {
+    "users": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at"),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)], name="created_at_id"),
+        IndexModel([("dns_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="dns_id_created_at_id"),
+        IndexModel([("active", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="active_created_at_id"),
+        IndexModel([("search_keys", ASCENDING)], name="search_keys"),
+    ],
+    "dns_servers": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "payments": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("date", DESCENDING), ("id", DESCENDING)], name="user_id_date_id"),
+        IndexModel([("status", ASCENDING), ("date", DESCENDING), ("id", DESCENDING)], name="status_date_id"),
+        IndexModel([("method", ASCENDING), ("date", DESCENDING), ("id", DESCENDING)], name="method_date_id"),
+        IndexModel([("date", ASCENDING), ("id", ASCENDING)], name="date_id"),
+    ],
+    "admins": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    ],
+    "templates": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "dns_health": [
+        IndexModel([("dns_id", ASCENDING), ("hour", ASCENDING)], name="dns_id_hour"),
+        IndexModel([("hour", ASCENDING)], name="hour_ttl", expireAfterSeconds=DNS_HEALTH_RETENTION_DAYS * 86400),
+    ],
+    "outbox": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)], name="status_next_attempt_at"),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)], name="user_id_created_at"),
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=OUTBOX_RETENTION_DAYS * 86400),
+    ],
+    "revenue_daily": [
+        IndexModel([("day", ASCENDING), ("method", ASCENDING), ("dns_id", ASCENDING)], name="day_method_dns_id", unique=True),
+    ],
+    "jobs": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("type", ASCENDING), ("started_at", DESCENDING)], name="type_started_at"),
+        IndexModel([("started_at", DESCENDING)], name="started_at"),
+    ],
+}
+
+# Indexes replaced by a wider one in INDEXES; dropped once the new one exists
+SUPERSEDED_INDEXES = {
+    "payments": ["user_id_date", "status_date"],
+}
+
+async def ensure_indexes():
+    # createIndexes is idempotent, so every replica can run this at startup. Each
+    # index gets its own call: one failed build must not keep the others from existing
+    for collection, indexes in INDEXES.items():
+        try:
+            existing = await db[collection].index_information()
+        except OperationFailure as e:
+            logger.error("Could not read indexes on %s: %s", collection, e)
+            continue
+        created, failed = [], []
+        for index in indexes:
+            name = index.document['name']
+            try:
+                await db[collection].create_indexes([index])
+            except OperationFailure as e:
+                # e.g. duplicated usernames created before the unique index existed
+                logger.error("Could not create index %s on %s: %s", name, collection, e)
+                failed.append(name)
+                continue
+            if name not in existing:
+                created.append(name)
+        if created:
+            logger.info("Created indexes on %s: %s", collection, ", ".join(created))
+        elif not failed:
+            logger.info("Indexes on %s already up to date", collection)
+        if failed:
+            # The superseded ones stay until every replacement could be built
+            continue
+        for name in SUPERSEDED_INDEXES.get(collection, []):
+            if name in existing:
+                try:
+                    await db[collection].drop_index(name)
+                    logger.info("Dropped superseded index %s on %s", name, collection)
+                except OperationFailure as e:
+                    logger.error("Could not drop superseded index %s on %s: %s", name, collection, e)
+
+# ==================== DATE MIGRATION ====================
+
+# Older releases stored dates as ISO strings. This converts them to native BSON
+# datetimes in batches while the app keeps serving, and folds the legacy
+# expire_date field into expires_at. It runs once; later startups only check the marker.
+DATE_FIELDS = {
+    "users": ["created_at", "expires_at", "expire_date"],
+    "payments": ["date"],
+    "dns_servers": ["created_at"],
+    "admins": ["created_at"],
+    "templates": ["created_at"],
+    "settings": ["updated_at"],
+}
+MIGRATION_BATCH_SIZE = 1000
+
+def date_migration_update(doc: dict, fields: List[str]) -> dict:
+    set_fields, unset_fields = {}, {}
+    for field in fields:
+        if isinstance(doc.get(field), str):
+            try:
+                set_fields[field] = parse_stored_datetime(doc[field])
+            except ValueError:
+                # Left as is; the _id walk in migrate_collection_dates moves past it
+                logger.warning("Unparseable %s on document %s: %r", field, doc['_id'], doc[field])
+    if 'expire_date' in doc:
+        expire_date = set_fields.pop('expire_date', doc['expire_date'])
+        if doc.get('expires_at') is None and isinstance(expire_date, datetime):
+            set_fields['expires_at'] = expire_date
+        if isinstance(expire_date, datetime):
+            unset_fields['expire_date'] = ""
+    update = {}
+    if set_fields:
+        update['$set'] = set_fields
+    if unset_fields:
+        update['$unset'] = unset_fields
+    return update
+
+async def migrate_collection_dates(collection: str, fields: List[str]) -> int:
+    query = {"$or": [{field: {"$type": "string"}} for field in fields]}
+    if 'expire_date' in fields:
+        query['$or'].append({"expire_date": {"$exists": True}})
+    projection = {field: 1 for field in fields}
+    migrated, last_id = 0, None
+    while True:
+        # Walk by _id so values that cannot be parsed are not retried forever
+        batch_query = {**query, "_id": {"$gt": last_id}} if last_id is not None else query
+        docs = await db[collection].find(batch_query, projection).sort("_id", ASCENDING).limit(MIGRATION_BATCH_SIZE).to_list(MIGRATION_BATCH_SIZE)
+        if not docs:
+            return migrated
+        last_id = docs[-1]['_id']
+        writes = []
+        for doc in docs:
+            update = date_migration_update(doc, fields)
+            if update:
+                writes.append(UpdateOne({"_id": doc['_id']}, update))
+        if writes:
+            result = await db[collection].bulk_write(writes, ordered=False)
+            migrated += result.modified_count
+
+async def migrate_dates():
+    if await db.migrations.find_one({"_id": "native_dates"}):
+        return
+    if not await acquire_lease("migrate_dates", 3600):
+        return
+    try:
+        for collection, fields in DATE_FIELDS.items():
+            migrated = await migrate_collection_dates(collection, fields)
+            logger.info("Converted dates to native datetimes on %s: %d documents", collection, migrated)
+        await db.migrations.insert_one({"_id": "native_dates", "done_at": datetime.now(timezone.utc)})
+        await rebuild_stats_snapshot()
+    except Exception as e:
+        logger.error("Date migration failed: %s", e)
+
+# ==================== BACKGROUND TASKS ====================
+
+# Strong references keep fire-and-forget tasks from being garbage collected
+background_tasks = set()
+
+def start_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def run_migrations():
+    # Revenue rollups are built from native dates, so they run after that migration
+    await migrate_dates()
+    await ensure_revenue_rollups()
+    await backfill_search_keys()
+
+@app.on_event("startup")
+async def startup_db_client():
+    await ensure_indexes()
+    await http_clients.start()
+    start_background(run_migrations())
+    await reference.load()
+    start_background(reference_refresher())
+    start_background(event_loop_lag_monitor())
+    start_background(stats_refresher())
+    start_background(dns_health_monitor())
+    start_background(reminder_scheduler())
+    for _ in range(OUTBOX_CONCURRENCY):
+        start_background(outbox_dispatcher())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await http_clients.close()
+    password_executor.shutdown(wait=False)
     client.close()
\ No newline at end of file
@@ -0,0 +1,54 @@
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Hashable
+
+
+class FailureThrottle:
+    """Bloqueia uma chave após muitas falhas dentro de uma janela deslizante"""
+
+    def __init__(self, name: str, max_failures: int, window: float, maxsize: int = 10000):
+        self.name = name
+        self.max_failures = max_failures
+        self.window = window
+        self.maxsize = maxsize
+        self.blocked = 0
+        self._failures: "OrderedDict[Hashable, deque]" = OrderedDict()
+
+    def _recent(self, key: Hashable) -> deque:
+        failures = self._failures.get(key)
+        if failures is None:
+            return deque()
+        cutoff = time.monotonic() - self.window
+        while failures and failures[0] <= cutoff:
+            failures.popleft()
+        if not failures:
+            del self._failures[key]
+        return failures
+
+    def retry_after(self, key: Hashable) -> float:
+        """Segundos até a chave poder tentar de novo (0 se liberada)"""
+        failures = self._recent(key)
+        if len(failures) < self.max_failures:
+            return 0.0
+        self.blocked += 1
+        return max(failures[0] + self.window - time.monotonic(), 0.0)
+
+    def record_failure(self, key: Hashable):
+        failures = self._recent(key)
+        failures.append(time.monotonic())
+        self._failures[key] = failures
+        self._failures.move_to_end(key)
+        # Only the most recently failing keys are tracked, so memory stays bounded
+        while len(self._failures) > self.maxsize:
+            self._failures.popitem(last=False)
+
+    def reset(self, key: Hashable):
+        self._failures.pop(key, None)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "tracked_keys": len(self._failures),
+            "max_failures": self.max_failures,
+            "window_seconds": self.window,
+            "blocked": self.blocked,
+        }
@@ -1,10 +1,67 @@
-import httpx
+import os
+import time
 from typing import Optional
+from http_client import http_clients
 
 WUZAPI_URL = "https://wuzapi.criartebrasil.com.br/api"
 INSTANCE_ID = "b2b170f60d445656efca18d92edc916d"
 TOKEN = "Arte@2025"
 
+class CircuitBreaker:
+    """Interrompe os envios enquanto a WuzAPI estiver falhando"""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        # Conta os resultados registrados; quem pegou a tentativa sabe se ela terminou
+        self.outcomes = 0
+        self._trial_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+        if self.state == "half_open" and not self._trial_in_flight:
+            # Uma única tentativa decide se o circuito fecha ou abre de novo
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def retry_in(self) -> float:
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def cancel_trial(self):
+        self._trial_in_flight = False
+
+    def record_success(self):
+        self.outcomes += 1
+        self.state = "closed"
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.outcomes += 1
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {"state": self.state, "failures": self.failures, "retry_in_seconds": round(self.retry_in(), 1)}
+
+
+wuzapi_breaker = CircuitBreaker(
+    failure_threshold=int(os.environ.get('WUZAPI_BREAKER_FAILURES', '5')),
+    reset_timeout=float(os.environ.get('WUZAPI_BREAKER_RESET_SECONDS', '60')),
+)
+
 async def send_whatsapp_message(phone: str, message: str, settings: dict) -> dict:
     """Envia mensagem WhatsApp via WuzAPI"""
     
@@ -14,14 +71,12 @@ async def send_whatsapp_message(phone: str, message: str, settings: dict) -> dic
     
     url = f"{settings['whatsapp_url']}/{settings['whatsapp_instance']}/messages/text"
     
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            url, 
-            json={"phone": phone_clean, "message": message},
-            headers={"Content-Type": "application/json", "Token": settings['whatsapp_token']},
-            timeout=30.0
-        )
-        return {"success": response.status_code == 200, "status": response.status_code}
+    response = await http_clients.wuzapi.post(
+        url, 
+        json={"phone": phone_clean, "message": message},
+        headers={"Content-Type": "application/json", "Token": settings['whatsapp_token']}
+    )
+    return {"success": response.status_code == 200, "status": response.status_code}
 
 def format_expiring_message(name: str, username: str, expires_at: str, plan_price: float, pay_url: str, notes: str = "") -> str:
     """Template mensagem de expiração"""
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+IPTV Management System - Backend Load Benchmark
+Starts the API locally against a local mongod, seeds synthetic data at the
+requested scales and measures RPS and p50/p95/p99 latency per endpoint.
+
+    python backend_benchmark.py --scales 1000,10000 --concurrency 50 --duration 20
+    python backend_benchmark.py --compare test_reports/benchmarks/<previous>.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+from pymongo import MongoClient
+
+ROOT_DIR = Path(__file__).parent
+BACKEND_DIR = ROOT_DIR / "backend"
+RESULTS_DIR = ROOT_DIR / "test_reports" / "benchmarks"
+
+ADMIN_EMAIL = "bench@admtv.local"
+ADMIN_PASSWORD = "bench-password"
+DNS_COUNT = 10
+SEED_BATCH_SIZE = 5000
+PAYMENT_METHODS = ["pix", "card", "cash"]
+ENDPOINTS = ["portal", "users", "users_page", "search", "stats", "payments_page", "login"]
+STARTUP_MIGRATIONS = ["native_dates", "revenue_rollups", "search_keys"]
+
+
+def seed_database(mongo_url: str, db_name: str, users: int, payments_per_user: int, seed: int) -> Dict[str, list]:
+    """Recreate the database with synthetic data shaped like the API writes it"""
+    rng = random.Random(seed)
+    client = MongoClient(mongo_url, tz_aware=True)
+    client.drop_database(db_name)
+    db = client[db_name]
+    now = datetime.now(timezone.utc)
+
+    servers = [{
+        "id": str(uuid.uuid4()),
+        "title": f"Painel {i}",
+        "url": f"http://panel{i}.bench.local:8080",
+        "active": True,
+        "created_at": now,
+    } for i in range(DNS_COUNT)]
+    db.dns_servers.insert_many(servers)
+
+    usernames, user_batch, payment_batch = [], [], []
+    for i in range(users):
+        server = servers[i % DNS_COUNT]
+        username, password = f"bench{i:07d}", f"pw{i}"
+        user = {
+            "id": str(uuid.uuid4()),
+            "username": username,
+            "password": password,
+            "dns_id": server['id'],
+            "name": f"Assinante {i}",
+            "phone": f"55119{i:08d}",
+            "mac_address": None,
+            "lista_m3u": f"{server['url']}/get.php?username={username}&password={password}&type=m3u_plus&output=mpegts",
+            "created_at": now - timedelta(seconds=users - i),
+            "expires_at": now + timedelta(days=rng.randint(-60, 120)),
+            "active": rng.random() > 0.1,
+            "pin": "0000",
+            "plan_price": 30.0,
+            "pay_url": None,
+            "last_validation": None,
+        }
+        usernames.append(username)
+        user_batch.append(user)
+        for _ in range(payments_per_user):
+            payment_batch.append({
+                "id": str(uuid.uuid4()),
+                "user_id": user['id'],
+                "amount": rng.choice([25.0, 30.0, 35.0, 90.0]),
+                "date": now - timedelta(days=rng.randint(0, 730), seconds=rng.randint(0, 86399)),
+                "status": "completed" if rng.random() > 0.05 else "pending",
+                "method": rng.choice(PAYMENT_METHODS),
+                "notes": None,
+                "dns_id": server['id'],
+            })
+        if len(user_batch) >= SEED_BATCH_SIZE:
+            db.users.insert_many(user_batch, ordered=False)
+            user_batch = []
+        if len(payment_batch) >= SEED_BATCH_SIZE:
+            db.payments.insert_many(payment_batch, ordered=False)
+            payment_batch = []
+    if user_batch:
+        db.users.insert_many(user_batch, ordered=False)
+    if payment_batch:
+        db.payments.insert_many(payment_batch, ordered=False)
+    client.close()
+    return {"usernames": usernames, "dns_ids": [server['id'] for server in servers]}
+
+
+def wait_for_migrations(mongo_url: str, db_name: str, timeout: float):
+    """Startup migrations (dates, revenue rollups, search keys) must finish before measuring"""
+    client = MongoClient(mongo_url)
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            if client[db_name].migrations.count_documents({"_id": {"$in": STARTUP_MIGRATIONS}}) == len(STARTUP_MIGRATIONS):
+                return
+            time.sleep(0.5)
+        print("  ⚠️  Startup migrations did not finish in time, measuring anyway")
+    finally:
+        client.close()
+
+
+class ServerProcess:
+    """uvicorn running the backend with its own database"""
+
+    def __init__(self, mongo_url: str, db_name: str, port: int, workers: int, concurrency: int):
+        self.base_url = f"http://127.0.0.1:{port}"
+        self.env = {
+            **os.environ,
+            "MONGO_URL": mongo_url,
+            "DB_NAME": db_name,
+            "SECRET_KEY": "benchmark-secret",
+            # The load comes from one IP; keep the login throttle out of the measurement
+            "LOGIN_MAX_FAILURES_PER_IP": "1000000",
+            # Every client may be waiting on bcrypt at once; a full queue answers with fast 503s
+            "PASSWORD_HASH_QUEUE": str(concurrency),
+        }
+        self.command = [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1",
+                        "--port", str(port), "--workers", str(workers), "--log-level", "warning"]
+        self.process: Optional[subprocess.Popen] = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen(self.command, cwd=BACKEND_DIR, env=self.env)
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("Backend exited during startup")
+            try:
+                httpx.get(f"{self.base_url}/api/portal/-", timeout=1)
+                return self
+            except httpx.HTTPError:
+                time.sleep(0.5)
+        raise RuntimeError("Backend did not start within 60s")
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q * len(ordered)) - 1))]
+
+
+def summarize(latencies: List[float], errors: int, statuses: Dict[str, int], elapsed: float) -> dict:
+    # Latency and throughput come from successful responses only; rejections
+    # (fast 429/503s) are counted in errors and statuses
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "error_rate": round(errors / (len(latencies) + errors), 4) if latencies or errors else 0.0,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2) if latencies else 0.0,
+        "statuses": statuses,
+    }
+
+
+def request_factory(endpoint: str, data: Dict[str, list], token: str, rng: random.Random):
+    auth = {"Authorization": f"Bearer {token}"}
+
+    def portal():
+        return "GET", f"/api/portal/{rng.choice(data['usernames'])}", {}, None
+
+    def users():
+        return "GET", "/api/users", auth, None
+
+    def users_page():
+        return "GET", f"/api/users/page?limit=50&dns_id={rng.choice(data['dns_ids'])}", auth, None
+
+    def search():
+        # Typeahead: the first characters of a random username
+        username = rng.choice(data['usernames'])
+        return "GET", f"/api/users/search?q={username[:rng.randint(6, len(username))]}", auth, None
+
+    def stats():
+        return "GET", "/api/stats", auth, None
+
+    def payments_page():
+        return "GET", "/api/payments/page?limit=50", auth, None
+
+    def login():
+        return "POST", "/api/auth/login", {}, {"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD}
+
+    return {
+        "portal": portal,
+        "users": users,
+        "users_page": users_page,
+        "search": search,
+        "stats": stats,
+        "payments_page": payments_page,
+        "login": login,
+    }[endpoint]
+
+
+async def run_load(base_url: str, endpoint: str, data: Dict[str, list], token: str,
+                   concurrency: int, duration: float, warmup: float, seed: int) -> dict:
+    rng = random.Random(seed)
+    next_request = request_factory(endpoint, data, token, rng)
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    errors = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        async def worker(stop_at: float, record: bool):
+            nonlocal errors
+            while time.perf_counter() < stop_at:
+                method, path, headers, body = next_request()
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, path, headers=headers, json=body)
+                    status = str(response.status_code)
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                elapsed = time.perf_counter() - start
+                if record:
+                    statuses[status] = statuses.get(status, 0) + 1
+                    if status.startswith(("2", "3")):
+                        latencies.append(elapsed)
+                    else:
+                        errors += 1
+
+        if warmup:
+            await asyncio.gather(*(worker(time.perf_counter() + warmup, False) for _ in range(concurrency)))
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(started + duration, True) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return summarize(latencies, errors, statuses, elapsed)
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(scale: int, results: Dict[str, dict]):
+    print(f"\n📊 {scale} users")
+    print(f"  {'endpoint':<15}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}{'err %':>8}")
+    for endpoint, result in results.items():
+        print(f"  {endpoint:<15}{result['rps']:>9}{result['p50_ms']:>10}{result['p95_ms']:>10}"
+              f"{result['p99_ms']:>10}{result['errors']:>8}{result['error_rate'] * 100:>8.1f}")
+
+
+def compare(current: dict, previous_path: Path, threshold: float, error_threshold: float) -> int:
+    """Print deltas against a previous run; returns 1 if any p95 or error rate regressed past its threshold"""
+    previous = json.loads(previous_path.read_text())
+    regressions = 0
+    print(f"\n🔍 Compared with {previous_path.name} ({previous.get('git_revision')})")
+    for scale, results in current['scales'].items():
+        for endpoint, result in results.items():
+            before = previous.get('scales', {}).get(scale, {}).get(endpoint)
+            if not before:
+                continue
+            # Latency only covers successful responses, so a build failing fast
+            # must be caught by its error rate
+            error_rate = result.get('error_rate', 0.0)
+            error_change = (error_rate - before.get('error_rate', 0.0)) * 100
+            change = (result['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 if before['p95_ms'] else 0.0
+            rps_change = (result['rps'] - before['rps']) / before['rps'] * 100 if before['rps'] else 0.0
+            regressed = change > threshold or error_change > error_threshold
+            flag = "❌" if regressed else "✅"
+            regressions += regressed
+            print(f"  {flag} {scale:>7} {endpoint:<15} p95 {before['p95_ms']} → {result['p95_ms']} ms "
+                  f"({change:+.1f}%), rps {rps_change:+.1f}%, errors {error_rate * 100:.1f}% ({error_change:+.1f} pts)")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load benchmark for the IPTV backend API")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--scales", default="1000,10000,100000", help="Comma separated user counts")
+    parser.add_argument("--payments-per-user", type=int, default=3)
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=20, help="Seconds measured per endpoint")
+    parser.add_argument("--warmup", type=float, default=3, help="Seconds of unmeasured load per endpoint")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--port", type=int, default=8011)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", type=Path, help="Results file (default: test_reports/benchmarks/<timestamp>.json)")
+    parser.add_argument("--compare", type=Path, help="Previous results file to compare against")
+    parser.add_argument("--regression-threshold", type=float, default=20, help="Allowed p95 increase in percent")
+    parser.add_argument("--error-threshold", type=float, default=1,
+                        help="Allowed error rate increase in percentage points")
+    parser.add_argument("--keep-data", action="store_true", help="Keep the benchmark databases")
+    args = parser.parse_args()
+
+    endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+
+    report = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items() if k != "mongo_url"},
+        "scales": {},
+    }
+
+    for scale in [int(s) for s in args.scales.split(",") if s.strip()]:
+        db_name = f"admtv_bench_{scale}"
+        print(f"\n🌱 Seeding {scale} users / {scale * args.payments_per_user} payments into {db_name}...")
+        started = time.perf_counter()
+        data = seed_database(args.mongo_url, db_name, scale, args.payments_per_user, args.seed)
+        print(f"  done in {time.perf_counter() - started:.1f}s")
+
+        with ServerProcess(args.mongo_url, db_name, args.port, args.workers, args.concurrency) as server:
+            wait_for_migrations(args.mongo_url, db_name, timeout=300)
+            token = httpx.post(f"{server.base_url}/api/auth/register", json={
+                "email": ADMIN_EMAIL, "name": "Benchmark", "password": ADMIN_PASSWORD,
+            }).json()["access_token"]
+
+            results = {}
+            for endpoint in endpoints:
+                print(f"  🚀 {endpoint}: {args.concurrency} concurrent clients for {args.duration}s")
+                results[endpoint] = asyncio.run(run_load(
+                    server.base_url, endpoint, data, token,
+                    args.concurrency, args.duration, args.warmup, args.seed,
+                ))
+            report["scales"][str(scale)] = results
+            print_table(scale, results)
+
+        if not args.keep_data:
+            MongoClient(args.mongo_url).drop_database(db_name)
+
+    report["finished_at"] = datetime.now(timezone.utc).isoformat()
+    output = args.output or RESULTS_DIR / f"{datetime.now():%Y%m%d-%H%M%S}-{report['git_revision'] or 'local'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"\n💾 Results saved to {output}")
+
+    if args.compare:
+        return compare(report, args.compare, args.regression_threshold, args.error_threshold)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "admtv_test")
+
+import server  # noqa: E402
+from wuzapi import CircuitBreaker  # noqa: E402
+
+
+def half_open_breaker():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    return breaker
+
+
+def test_opens_after_threshold_and_closes_on_success():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    assert breaker.retry_in() > 0
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_half_open_allows_a_single_trial():
+    breaker = half_open_breaker()
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+
+
+def test_cancel_releases_the_trial():
+    breaker = half_open_breaker()
+    assert breaker.allow()
+    breaker.cancel_trial()
+    assert breaker.allow()
+
+
+def test_failed_trial_reopens_and_releases():
+    breaker = half_open_breaker()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    # reset_timeout=0: the next call half-opens again with a fresh trial
+    assert breaker.allow()
+
+
+def run_dispatcher_briefly(monkeypatch, breaker, claim, deliver):
+    monkeypatch.setattr(server, "wuzapi_breaker", breaker)
+    monkeypatch.setattr(server, "claim_outbox_message", claim)
+    monkeypatch.setattr(server, "deliver_outbox_message", deliver)
+    monkeypatch.setattr(server, "OUTBOX_POLL_SECONDS", 0.01)
+
+    async def outbox_throttle():
+        pass
+    monkeypatch.setattr(server, "outbox_throttle", outbox_throttle)
+
+    async def run():
+        task = asyncio.create_task(server.outbox_dispatcher())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    asyncio.run(run())
+
+
+def test_dispatcher_releases_trial_when_delivery_records_nothing(monkeypatch):
+    # e.g. "WhatsApp not configured": the message is rescheduled without calling WuzAPI
+    breaker = half_open_breaker()
+    delivered = []
+
+    async def claim():
+        await asyncio.sleep(0)
+        return {"id": "m1", "attempts": 1}
+
+    async def deliver(message):
+        await asyncio.sleep(0)
+        delivered.append(message['id'])
+
+    run_dispatcher_briefly(monkeypatch, breaker, claim, deliver)
+    assert len(delivered) > 1
+    assert breaker.state == "half_open" and not breaker._trial_in_flight
+
+
+def test_dispatcher_releases_trial_when_claim_fails(monkeypatch):
+    breaker = half_open_breaker()
+
+    async def claim():
+        raise RuntimeError("database unavailable")
+
+    async def deliver(message):
+        raise AssertionError("nothing was claimed")
+
+    run_dispatcher_briefly(monkeypatch, breaker, claim, deliver)
+    assert not breaker._trial_in_flight
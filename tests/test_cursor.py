@@ -0,0 +1,59 @@
+import base64
+import json
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "admtv_test")
+
+import server  # noqa: E402
+from fastapi import HTTPException  # noqa: E402
+
+
+def raw_cursor(value) -> str:
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+
+def test_round_trip_keeps_datetimes():
+    created_at = datetime(2026, 10, 1, 12, 30, tzinfo=timezone.utc)
+    cursor = server.encode_cursor([created_at, "user-id"])
+    assert server.decode_cursor(cursor) == [created_at, "user-id"]
+
+
+def test_keyset_filter_seeks_past_the_last_pair():
+    cursor = server.encode_cursor(["maria", "user-id"])
+    assert server.keyset_filter("username", cursor, descending=False) == {"$or": [
+        {"username": {"$gt": "maria"}},
+        {"username": "maria", "id": {"$gt": "user-id"}},
+    ]}
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64 !",
+    raw_cursor({"a": 1}),
+    raw_cursor([{"$date": "yesterday"}, "id"]),
+    raw_cursor([{"$date": 5}, "id"]),
+])
+def test_malformed_cursor_is_rejected(cursor):
+    with pytest.raises(HTTPException) as error:
+        server.decode_cursor(cursor)
+    assert error.value.status_code == 400
+
+
+@pytest.mark.parametrize("values", [
+    [{"$ne": None}, "id"],
+    [{"$date": "2026-10-01T00:00:00+00:00", "$gt": ""}, "id"],
+    [["a", "b"], "id"],
+    ["maria", {"$gt": ""}],
+    ["maria", 5],
+    ["maria"],
+])
+def test_operators_and_non_scalars_never_reach_the_query(values):
+    with pytest.raises(HTTPException) as error:
+        server.keyset_filter("username", raw_cursor(values), descending=False)
+    assert error.value.status_code == 400
@@ -0,0 +1,35 @@
+import io
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "admtv_test")
+
+import server  # noqa: E402
+
+
+def read_rows(data: bytes):
+    return [row for _, row in server.iter_csv_rows(io.BytesIO(data))]
+
+
+def test_comma_separated_utf8_with_bom():
+    rows = read_rows("﻿username,name\njoao,João Silva\n".encode("utf-8"))
+    assert rows == [{"username": "joao", "name": "João Silva"}]
+
+
+def test_excel_ptbr_export_uses_semicolon_and_cp1252():
+    rows = read_rows("username;name;plan_price\njoao;João Conceição;29,90\n".encode("cp1252"))
+    assert rows == [{"username": "joao", "name": "João Conceição", "plan_price": "29,90"}]
+
+
+def test_single_column_falls_back_to_comma():
+    assert read_rows(b"username\njoao\nmaria\n") == [{"username": "joao"}, {"username": "maria"}]
+
+
+def test_invalid_utf8_late_in_the_file_switches_the_whole_file_to_cp1252():
+    data = b"username,name\n" + b"user,Nome\n" * 20000 + "ana,Conceição\n".encode("cp1252")
+    rows = read_rows(data)
+    assert len(rows) == 20001
+    assert rows[-1] == {"username": "ana", "name": "Conceição"}
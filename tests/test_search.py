@@ -0,0 +1,43 @@
+import os
+import sys
+from pathlib import Path
+
+from bson import encode
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "admtv_test")
+
+import server  # noqa: E402
+
+
+def test_keys_are_lowercase_without_accents():
+    keys = server.user_search_keys({"username": "Joao123", "name": "João  da SILVA"})
+    assert keys == ["da", "joao", "joao da silva", "joao123", "silva"]
+
+
+def test_phone_keys_cover_country_code_ddd_and_number():
+    keys = server.user_search_keys({"username": "u", "phone": "+55 (11) 98765-4321"})
+    assert {"5511987654321", "11987654321", "987654321"} <= set(keys)
+
+
+def test_mac_address_is_reduced_to_hex():
+    keys = server.user_search_keys({"username": "u", "mac_address": "00:1A:79:AB:CD:EF"})
+    assert "001a79abcdef" in keys
+
+
+def test_missing_fields_add_no_keys():
+    assert server.user_search_keys({"username": "u", "name": None, "phone": "", "mac_address": None}) == ["u"]
+
+
+def test_search_terms_match_the_stored_keys():
+    assert "joao" in server.search_terms("João")
+    assert "11987654321" in server.search_terms("(11) 98765-4321")
+
+
+def test_prefix_patterns_carry_no_regex_options():
+    # A "u" option would keep the planner from using tight index bounds
+    patterns = server.search_patterns(["joao", "a.b"], prefix=True)
+    assert [(pattern.pattern, pattern.flags) for pattern in patterns] == [("^joao", 0), ("^a\\.b", 0)]
+    assert b"^joao\x00\x00" in encode({"search_keys": patterns[0]})
+    assert server.search_patterns(["joao"], prefix=False)[0].pattern == "joao"
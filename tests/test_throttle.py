@@ -0,0 +1,86 @@
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "admtv_test")
+
+import server  # noqa: E402
+import throttle  # noqa: E402
+from throttle import FailureThrottle  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_throttle(monkeypatch, **kwargs):
+    clock = FakeClock()
+    monkeypatch.setattr(throttle.time, "monotonic", clock)
+    return FailureThrottle("test", **{"max_failures": 3, "window": 60, **kwargs}), clock
+
+
+def test_blocks_after_max_failures(monkeypatch):
+    limiter, clock = make_throttle(monkeypatch)
+    for _ in range(2):
+        limiter.record_failure("1.2.3.4")
+    assert limiter.retry_after("1.2.3.4") == 0
+    limiter.record_failure("1.2.3.4")
+    assert limiter.retry_after("1.2.3.4") == 60
+    assert limiter.retry_after("5.6.7.8") == 0
+    assert limiter.stats()["blocked"] == 1
+
+
+def test_failures_slide_out_of_the_window(monkeypatch):
+    limiter, clock = make_throttle(monkeypatch)
+    limiter.record_failure("key")
+    clock.now += 30
+    limiter.record_failure("key")
+    limiter.record_failure("key")
+    assert limiter.retry_after("key") == 30
+    clock.now += 30
+    # The first failure expired; two remain
+    assert limiter.retry_after("key") == 0
+
+
+def test_reset_clears_the_key(monkeypatch):
+    limiter, clock = make_throttle(monkeypatch)
+    for _ in range(3):
+        limiter.record_failure("key")
+    limiter.reset("key")
+    assert limiter.retry_after("key") == 0
+    assert limiter.stats()["tracked_keys"] == 0
+
+
+def test_tracks_at_most_maxsize_keys(monkeypatch):
+    limiter, clock = make_throttle(monkeypatch, maxsize=2)
+    for key in ("a", "b", "c"):
+        limiter.record_failure(key)
+    assert limiter.stats()["tracked_keys"] == 2
+    for _ in range(2):
+        limiter.record_failure("a")
+    # "a" was evicted as the oldest key, so its first failure is gone
+    assert limiter.retry_after("a") == 0
+
+
+def login_request(forwarded=None):
+    headers = {"x-forwarded-for": forwarded} if forwarded else {}
+    return SimpleNamespace(headers=headers, client=SimpleNamespace(host="10.0.0.9"))
+
+
+def test_forwarded_for_is_ignored_without_trusted_proxies(monkeypatch):
+    monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 0)
+    assert server.client_ip(login_request("1.2.3.4")) == "10.0.0.9"
+
+
+def test_forwarded_for_uses_the_entry_added_by_the_proxy(monkeypatch):
+    monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 1)
+    # The client spoofed the first entry; Traefik appended the real address
+    assert server.client_ip(login_request("1.2.3.4, 200.1.1.1")) == "200.1.1.1"
+    assert server.client_ip(login_request()) == "10.0.0.9"
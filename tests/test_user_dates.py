@@ -0,0 +1,69 @@
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "admtv_test")
+
+import server  # noqa: E402
+
+
+def date_only_user(expires_at="2026-12-31"):
+    data = server.UserCreate(username="joao", password="pw", dns_id="dns", expires_at=expires_at)
+    return server.User(**data.model_dump(), lista_m3u=None).model_dump()
+
+
+def test_date_only_expires_at_is_midnight_in_business_timezone():
+    expires_at = server.UserCreate(username="joao", password="pw", dns_id="dns", expires_at="2026-12-31").expires_at
+    assert expires_at.tzinfo is not None
+    assert expires_at.astimezone(server.BUSINESS_TIMEZONE).date().isoformat() == "2026-12-31"
+    assert expires_at == datetime(2026, 12, 31, tzinfo=server.BUSINESS_TIMEZONE)
+
+
+def test_explicit_offset_is_kept():
+    expires_at = server.UserUpdate(expires_at="2026-12-31T10:00:00Z").expires_at
+    assert expires_at == datetime(2026, 12, 31, 10, tzinfo=timezone.utc)
+    assert server.UserUpdate().expires_at is None
+
+
+def test_stats_accept_date_only_payload():
+    # Used to raise "can't compare offset-naive and offset-aware datetimes"
+    assert server.user_stats_delta(None, date_only_user()) == {"total_users": 1, "active_users": 1, "expired_users": 0}
+    assert server.user_stats_delta(None, date_only_user("2020-01-01")) == {"total_users": 1, "active_users": 1, "expired_users": 1}
+
+
+def test_import_rows_use_the_same_boundary():
+    doc = server.build_import_doc(
+        {"username": "maria", "password": "pw", "dns_id": "dns", "expires_at": "2026-12-31"},
+        {"dns": {"id": "dns", "url": "http://panel"}},
+    )
+    assert doc['expires_at'] == datetime(2026, 12, 31, tzinfo=server.BUSINESS_TIMEZONE)
+
+
+def test_legacy_strings_are_read_in_business_timezone():
+    assert server.parse_stored_datetime("2026-12-31") == datetime(2026, 12, 31, tzinfo=server.BUSINESS_TIMEZONE)
+    assert server.parse_stored_datetime("2026-12-31T00:00:00") == datetime(2026, 12, 31, tzinfo=server.BUSINESS_TIMEZONE)
+    assert server.parse_stored_datetime("2026-12-31T10:00:00Z") == datetime(2026, 12, 31, 10, tzinfo=timezone.utc)
+
+
+def test_reminder_shows_the_admin_date():
+    user = date_only_user()
+    assert "31/12/2026" in server.render_reminder(user)
+
+
+def test_reminder_accepts_dates_not_yet_migrated():
+    user = {**date_only_user(), "expires_at": "2026-12-31T00:00:00"}
+    assert "31/12/2026" in server.render_reminder(user)
+    assert server.read_stored_datetime("not a date") is None
+    assert server.read_stored_datetime(None) is None
+
+
+def test_range_filters_use_business_days():
+    bounds = server.date_range_filter("date", datetime(2026, 10, 1), datetime(2026, 11, 1, tzinfo=timezone.utc))
+    assert bounds == {"date": {
+        "$gte": datetime(2026, 10, 1, tzinfo=server.BUSINESS_TIMEZONE),
+        "$lt": datetime(2026, 11, 1, tzinfo=timezone.utc),
+    }}
+    assert bounds["date"]["$gte"] == server.local_day_start(datetime(2026, 10, 1).date())